@@ -0,0 +1,35 @@
+"""Per-item calls of a model-style function compared to batch_map
+
+The model has a fixed cost per call, like a forward pass, and a small cost per item.
+
+    PYTHONPATH=. python benchmarks/bench_batch_map.py [records] [processes]
+"""
+import sys
+from time import perf_counter, sleep
+
+from jf.process import run_query
+
+
+def model(texts):
+    sleep(0.0005 + 0.00001 * len(texts))
+    return [len(t) for t in texts]
+
+
+QUERIES = {
+    "per item": "{id, n: model([.text])[0]}",
+    "batch_map": 'batch_map(model, field="text", into="n", size=64), {id, n}',
+}
+
+
+def main(n=2000, processes=1):
+    data = [{"id": i, "text": "w" * (i % 50)} for i in range(n)]
+    additionals = {"JF_init_codes": [], "model": model}
+    for name, query in QUERIES.items():
+        start = perf_counter()
+        ret = list(run_query(query, data, additionals, processes=processes))
+        assert len(ret) == n
+        print(f"{name:>10}: {(perf_counter() - start) / n * 1e6:7.1f} us/record")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
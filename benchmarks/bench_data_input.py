@@ -0,0 +1,45 @@
+"""Throughput of reading a local jsonl file, repeatedly as in exploratory use
+
+    python benchmarks/bench_data_input.py [file.jsonl] [repeats]
+"""
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from jf.jfio import map_file, read_chunks, yield_json_and_json_lines
+
+
+def make_file(records=1000000):
+    with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as f:
+        for i in range(records):
+            rec = {"id": i, "user": {"id": i % 100, "name": "x" * 30}, "ts": "2020-01-01"}
+            f.write(json.dumps(rec).encode() + b"\n")
+    return f.name
+
+
+def bench(name, fn, source, repeats):
+    size = os.path.getsize(fn)
+    for _ in range(repeats):
+        start = perf_counter()
+        with open(fn, "rb") as f:
+            n = sum(1 for _ in yield_json_and_json_lines(source(f), decode=True))
+        took = perf_counter() - start
+        print(f"{name:>8}: {n:>9} items {size / took / 1e6:8.1f} MB/s")
+
+
+def main(fn=None, repeats=3):
+    tmp = fn is None
+    fn = make_file() if tmp else fn
+    try:
+        bench("lines", fn, lambda f: f, int(repeats))
+        bench("chunks", fn, read_chunks, int(repeats))
+        bench("mmap", fn, map_file, int(repeats))
+    finally:
+        if tmp:
+            os.unlink(fn)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
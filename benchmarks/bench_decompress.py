@@ -0,0 +1,33 @@
+"""Throughput of reading compressed jsonl, decompressing inline or in a background thread
+
+    python benchmarks/bench_decompress.py [records]
+"""
+import gzip
+import io
+import json
+import sys
+from time import perf_counter
+
+from jf.jfio import decompressed, input_chunks, read_chunks, yield_json_and_json_lines
+
+
+def main(records=500000):
+    data = b"".join(
+        json.dumps({"id": i, "name": "x" * 30, "tags": ["a", "b"]}).encode() + b"\n"
+        for i in range(records)
+    )
+    compressed = gzip.compress(data)
+
+    def bench(name, chunks):
+        start = perf_counter()
+        f = io.BufferedReader(io.BytesIO(compressed))
+        n = sum(1 for _ in yield_json_and_json_lines(chunks(f), decode=True))
+        took = perf_counter() - start
+        print(f"{name:>8}: {n:>9} items {len(data) / took / 1e6:8.1f} MB/s")
+
+    bench("inline", lambda f: read_chunks(decompressed(f, "gz")))
+    bench("threaded", input_chunks)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
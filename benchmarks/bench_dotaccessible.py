@@ -0,0 +1,48 @@
+"""Cost of wrapping records as DotAccessible and of reading their fields
+
+    python benchmarks/bench_dotaccessible.py [records]
+"""
+import sys
+import tracemalloc
+from timeit import timeit
+
+from jf.process import dotaccessible
+
+
+def record(i):
+    return {
+        "id": i,
+        "status": "error" if i % 2 else "ok",
+        "ts": i * 1000,
+        "msg": "request handled",
+        "user": {"name": f"u{i}", "email": None, "groups": ["a", "b"]},
+        "request": {"path": "/api", "headers": {"host": "x", "agent": "y"}},
+        "tags": ["t1", "t2"],
+        "extra": None,
+    }
+
+
+def main(records=100000):
+    data = [record(i) for i in range(records)]
+
+    tracemalloc.start()
+    wrapped = [dotaccessible(it) for it in data]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{'memory':>14}: {size / records:8.0f} bytes/record")
+    del wrapped
+
+    n = 100000
+    it = dotaccessible(record(1))
+    for name, stmt in [
+        ("wrap", lambda: dotaccessible(data[0])),
+        ("flat field", lambda: it.status),
+        ("nested field", lambda: it.request.headers.host),
+        ("missing field", lambda: it.nothere),
+        ("wrap + 2 reads", lambda: (lambda x: (x.status, x.user.name))(dotaccessible(data[0]))),
+    ]:
+        print(f"{name:>14}: {timeit(stmt, number=n) / n * 1e9:8.0f} ns")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,35 @@
+"""Parent memory and throughput of --processes with a fast reader
+
+The workers cost `cost` squares per item, and the output takes `output` ms per 100
+items, like writing to a slow pipe.
+
+    python benchmarks/bench_in_flight.py [records] [processes] [cost] [output]
+"""
+import resource
+import sys
+from time import perf_counter, sleep
+
+from jf.process import run_query
+
+
+def heavy(n):
+    return sum(i * i for i in range(n))
+
+
+def main(records=200000, processes=2, cost=300, output=0):
+    data = ({"id": i, "n": cost, "pad": "x" * 200} for i in range(records))
+    additionals = {"JF_init_codes": [], "heavy": heavy}
+    query = "{id, h: heavy(.n), pad}"
+    start = perf_counter()
+    n = 0
+    for _ in run_query(query, data, additionals, processes=processes):
+        n += 1
+        if output and n % 100 == 0:
+            sleep(output / 1000)
+    elapsed = perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{n} items {elapsed:.2f}s {n / elapsed:.0f} items/s, parent rss {rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
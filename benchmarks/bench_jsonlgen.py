@@ -0,0 +1,62 @@
+"""Throughput of the jsonlgen scanner for the different input types
+
+    python benchmarks/bench_jsonlgen.py [megabytes]
+"""
+import io
+import json
+import sys
+from time import perf_counter
+
+from jf import jsonlgen
+
+
+def make_jsonl(size):
+    record = json.dumps(
+        {"id": 12345, "user": {"id": 1, "name": "äö \"quoted\""}, "tags": ["a", "b"]}
+    )
+    line = (record + "\n").encode()
+    return line * (size // len(line))
+
+
+def split_and_loads(inp):
+    for it in jsonlgen.gen(inp):
+        try:
+            yield json.loads(it)
+        except Exception:
+            pass
+
+
+def bench(name, make_input, size, gen=jsonlgen.gen):
+    start = perf_counter()
+    n = sum(1 for _ in gen(make_input()))
+    took = perf_counter() - start
+    print(f"{name:>12}: {n:>9} items {size / took / 1e6:8.1f} MB/s")
+
+
+def main(megabytes=100):
+    data = make_jsonl(int(megabytes * 1e6))
+    size = len(data)
+    bench("str lines", lambda: map(lambda x: x.decode(), io.BytesIO(data)), size)
+    bench("bytes lines", lambda: io.BytesIO(data), size)
+    bench("buffer", lambda: data, size)
+    bench("memoryview", lambda: memoryview(data), size)
+    bench("split+loads", lambda: data, size, split_and_loads)
+    bench("decode", lambda: data, size, lambda x: jsonlgen.gen(x, decode=True))
+    fields = {"id": None}
+    bench(
+        "fields",
+        lambda: data,
+        size,
+        lambda x: jsonlgen.gen(x, decode=True, fields=fields),
+    )
+    needle = [[b'"missing"']]
+    bench(
+        "prefilter",
+        lambda: data,
+        size,
+        lambda x: jsonlgen.gen(x, decode=True, prefilter=needle),
+    )
+
+
+if __name__ == "__main__":
+    main(*map(float, sys.argv[1:]))
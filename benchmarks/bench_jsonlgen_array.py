@@ -0,0 +1,36 @@
+"""Throughput of jsonlgen on a single huge json array
+
+The array is streamed in chunks, as data_input reads files, so throughput should stay flat
+as the document grows.
+
+    python benchmarks/bench_jsonlgen_array.py [megabytes ...]
+"""
+import json
+import sys
+from time import perf_counter
+
+from jf import jsonlgen
+
+CHUNK = 1 << 20
+
+
+def array_chunks(size):
+    item = json.dumps({"id": 12345, "name": "[not, the] {end}", "tags": ["a", "b"]})
+    items = (item + ", ") * (CHUNK // (len(item) + 2))
+    yield b"["
+    for _ in range(size // len(items)):
+        yield items.encode()
+    yield item.encode() + b"]"
+
+
+def main(*megabytes):
+    for mb in megabytes or (10, 100, 1000):
+        size = int(mb * 1e6)
+        start = perf_counter()
+        n = sum(1 for _ in jsonlgen.gen(array_chunks(size)))
+        took = perf_counter() - start
+        print(f"{mb:>8} MB: {n:>10} items {size / took / 1e6:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main(*map(float, sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""Per record overhead of long single process pipelines in mymap
+
+    python benchmarks/bench_pipeline.py [records]
+"""
+import sys
+from time import perf_counter
+
+from jf.process import run_query
+
+QUERY = """(.status == "error"),
+{ts2: .ts * 2, ...},
+{id: .id, ts2: .ts2, user: .user.name, n: .n},
+(.n > 1),
+{tag: "x", ...}
+"""
+
+# Enrichment of wide records, with stateful stages in between
+WIDE_QUERY = """{a: .k1 + 1, ...},
+first(100000000),
+(.k2 % 2),
+{b: .a * 2, ...},
+first(100000000),
+{c: .b, ...},
+first(100000000)
+"""
+
+
+def run(name, query, data):
+    start = perf_counter()
+    n = sum(1 for _ in run_query(" ".join(query.split()), data, {"JF_init_codes": []}))
+    elapsed = perf_counter() - start
+    print(f"{name:>6}: {n} items {elapsed:.2f}s {elapsed / len(data) * 1e6:.2f} us/record")
+
+
+def main(records=200000):
+    data = [
+        {
+            "id": i,
+            "ts": i,
+            "status": "error" if i % 2 else "ok",
+            "n": i % 5,
+            "user": {"name": f"u{i % 10}", "groups": ["a", "b"]},
+            "message": "m" * 40,
+        }
+        for i in range(records)
+    ]
+    run("long", QUERY, data)
+    wide = [{f"k{j}": i + j for j in range(200)} for i in range(records // 4)]
+    run("wide", WIDE_QUERY, wide)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,29 @@
+"""Work left in the parent process with --processes, for stages after a stateful one
+
+    PYTHONPATH=. python benchmarks/bench_plan.py [records] [processes]
+"""
+import sys
+from time import perf_counter, process_time
+
+from jf.process import run_query
+
+
+def heavy(n):
+    return sum(i * i for i in range(n))
+
+
+QUERY = "sorted(.a), {id, h: heavy(.n)}, (.h % 2 == 0), .id"
+
+
+def main(records=20000, processes=4):
+    data = [{"id": i, "a": (i * 7) % 101, "n": 2000 + i % 50} for i in range(records)]
+    additionals = {"JF_init_codes": [], "heavy": heavy}
+    for procs in [1, processes]:
+        start, cpu = perf_counter(), process_time()
+        n = sum(1 for _ in run_query(QUERY, data, additionals, processes=procs))
+        wall, cpu = perf_counter() - start, process_time() - cpu
+        print(f"{procs:>2} processes: {n} items {wall:.2f}s, parent cpu {cpu:.2f}s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
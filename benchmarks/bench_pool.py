@@ -0,0 +1,33 @@
+"""Throughput of the multiprocessing path of mymap
+
+    python benchmarks/bench_pool.py [records] [processes]
+"""
+import json
+import sys
+from time import perf_counter
+
+from jf import jsonlgen
+from jf.jfio import BATCH_SIZE
+from jf.process import mymap
+
+
+def main(records=1000000, processes=4):
+    data = b"".join(
+        json.dumps({"a": i % 3, "b": "x" * 20}).encode() + b"\n" for i in range(records)
+    )
+    fs = [["filter", lambda x: x.a > 0], ["update", lambda x: {"c": x.a * 2}]]
+
+    def run(name, **kwargs):
+        start = perf_counter()
+        n = sum(1 for _ in mymap(fs, make(**kwargs), processes, **kwargs))
+        print(f"{name:>12}: {n:>9} items {records / (perf_counter() - start):10.0f} items/s")
+
+    def make(batched=False):
+        return jsonlgen.gen(data, decode=True, batch=BATCH_SIZE if batched else 0)
+
+    run("records")
+    run("batches", batched=True)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
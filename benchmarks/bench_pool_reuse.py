@@ -0,0 +1,30 @@
+"""Latency of running the same query again with --processes, by start method
+
+The pool of a pipeline started with spawn or forkserver is kept between runs.
+
+    python benchmarks/bench_pool_reuse.py [runs] [records] [processes]
+"""
+import sys
+from time import perf_counter
+
+from jf.process import run_query
+
+
+def main(runs=10, records=1000, processes=2):
+    data = [{"id": i, "a": i % 7} for i in range(records)]
+    additionals = {"JF_init_codes": ["import math"]}
+    query = "(.a > 2), {id, b: math.sqrt(.a)}, .b"
+    for method in ["fork", "spawn", "forkserver"]:
+        times = []
+        options = {"processes": processes, "start_method": method}
+        for _ in range(runs):
+            start = perf_counter()
+            ret = list(run_query(query, data, additionals, **options))
+            times.append(perf_counter() - start)
+        assert len(ret) == sum(1 for it in data if it["a"] > 2)
+        first, later = times[0] * 1e3, sum(times[1:]) / max(len(times) - 1, 1) * 1e3
+        print(f"{method:>10}: first run {first:6.1f} ms, then {later:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
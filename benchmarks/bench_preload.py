@@ -0,0 +1,45 @@
+"""Memory of the worker processes with a large object from --init
+
+The workers run a full garbage collection and report their private memory, which
+is the part of the parent's memory they have had to copy.
+
+    python benchmarks/bench_preload.py [objects] [processes]
+"""
+import gc
+import os
+import sys
+from time import perf_counter
+
+from jf.process import run_query
+
+
+def private_mb(_measured={}):
+    if os.getpid() not in _measured:
+        gc.collect()
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Private_Dirty:"):
+                    _measured[os.getpid()] = int(line.split()[1]) / 1024
+    return _measured[os.getpid()]
+
+
+def main(objects=2000000, processes=2):
+    # Like the weights of a model, made of objects that the garbage collector tracks
+    init = [f"model = [{{'w': [i]}} for i in range({objects})]"]
+    query = "{pid: os.getpid(), mb: private_mb(), n: len(model)}"
+    freeze = gc.freeze
+    for name in ["gc.freeze", "no freeze", "worker_init"]:
+        if name == "no freeze":
+            gc.freeze = lambda: None
+        codes = "JF_worker_init_codes" if name == "worker_init" else "JF_init_codes"
+        additionals = {codes: init, "private_mb": private_mb, "os": os}
+        start = perf_counter()
+        ret = list(run_query(query, [{}] * 1000, additionals, processes=processes))
+        workers = {it["pid"]: it["mb"] for it in ret}
+        elapsed, total = perf_counter() - start, sum(workers.values())
+        print(f"{name:>11}: {elapsed:.2f}s, {len(workers)} workers {total:.0f} MB private")
+        gc.freeze = freeze
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,40 @@
+"""Head-of-line blocking of --processes with a few slow records
+
+One record in `every` takes `slow` ms, like a long document, and the rest are fast.
+
+    python benchmarks/bench_reorder.py [records] [processes] [every] [slow]
+"""
+import sys
+from time import perf_counter, sleep
+
+from jf.process import run_query
+
+
+def work(n):
+    if n:
+        sleep(n / 1000)
+    return n
+
+
+def main(records=20000, processes=4, every=500, slow=200):
+    data = [{"id": i, "n": slow if i % every == 0 else 0} for i in range(records)]
+    additionals = {"JF_init_codes": [], "work": work}
+    for name, window in [("ordered", 0), ("window 1000", 1000), ("unordered", 1e309)]:
+        start = perf_counter()
+        ret = list(
+            run_query(
+                "{id, w: work(.n)}, .id",
+                data,
+                additionals,
+                processes=processes,
+                reorder_window=window,
+            )
+        )
+        elapsed = perf_counter() - start
+        displaced = max(abs(i - j) for i, j in enumerate(ret))
+        assert sorted(ret) == list(range(records))
+        print(f"{name:>12}: {elapsed:.2f}s, max displacement {displaced}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+"""Startup latency of running a .jf script, with and without the compiled query cache
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+SCRIPT = """#!/usr/bin/env jf
+#import hashlib
+(.status == "error" and .ts > 1000),
+{id, ts, msg: .message.strip()[:80], user: .user.name,
+ hash: hashlib.md5(.message.encode()).hexdigest()},
+sorted(.ts),
+first(10)
+"""
+
+
+def main(runs=20):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        script = os.path.join(tmpdir, "query.jf")
+        data = os.path.join(tmpdir, "data.json")
+        with open(script, "w") as f:
+            f.write(SCRIPT)
+        with open(data, "w") as f:
+            f.write('{"id": 1, "status": "ok", "ts": 1}\n')
+        cmd = [sys.executable, "-m", "jf", "-c", script, data]
+
+        def bench(name, cache_dir):
+            env = dict(os.environ, JF_CACHE_DIR=cache_dir)
+            subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+            start = perf_counter()
+            for _ in range(runs):
+                subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+            print(f"{name:>12}: {(perf_counter() - start) / runs * 1000:6.1f} ms/run")
+
+        bench("no cache", "")
+        bench("cached", os.path.join(tmpdir, "cache"))
+
+    from jf.query_parser import compile_query, parse_query
+
+    def bench_compile(name, fn, n=2000):
+        start = perf_counter()
+        for _ in range(n):
+            fn()
+        print(f"{name:>12}: {(perf_counter() - start) / n * 1e6:6.1f} us/query")
+
+    query = " ".join(SCRIPT.splitlines()[2:])
+    bench_compile("parse+eval", lambda: eval(parse_query(query)[0], {}))
+    bench_compile("compiled", lambda: compile_query(query))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,47 @@
+"""Per record and columnar (--vectorize) execution of numeric queries
+
+    python benchmarks/bench_vectorized.py [records]
+"""
+import random
+import sys
+from time import perf_counter
+
+from jf.jfio import BATCH_SIZE
+from jf.process import run_query
+
+QUERIES = [
+    "{ratio: .a / .b, ...}, (.ratio > 0.9)",
+    "{ratio: .a / .b, load: (.c + .d) * 0.5, hot: .e > 80, ...}, "
+    '(.ratio > 0.5 and .load < 60 and .host == "h1")',
+]
+
+
+def main(records=500000):
+    import numpy  # noqa: F401, not part of the timings
+
+    rng = random.Random(0)
+    data = [
+        dict(
+            {k: rng.random() * 100 for k in "abcde"},
+            host=f"h{i % 4}",
+            ts=i,
+        )
+        for i in range(records)
+    ]
+    batches = [data[i : i + BATCH_SIZE] for i in range(0, records, BATCH_SIZE)]
+    for query in QUERIES:
+        print(query)
+        for vectorize in (False, True):
+            start = perf_counter()
+            ret = run_query(
+                query, batches, {"JF_init_codes": []}, batched=True, vectorize=vectorize
+            )
+            n = sum(1 for _ in ret)
+            elapsed = perf_counter() - start
+            name = "vectorized" if vectorize else "per record"
+            per_record = elapsed / records * 1e6
+            print(f"{name:>12}: {n} items {elapsed:.2f}s {per_record:.2f} us/record")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
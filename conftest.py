@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True, scope="session")
+def query_cache_dir(tmp_path_factory):
+    """Keep the queries compiled by the tests out of the cache of the user"""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("JF_CACHE_DIR", str(tmp_path_factory.mktemp("jf-cache")))
+        yield
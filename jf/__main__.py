@@ -22,6 +22,11 @@ from .main import jf
 @click.option("--listen", help="listen to http input.")
 @click.option("--debug", help="show debug.", is_flag=True)
 @click.option("--init", help="run initialization code", multiple=True)
+@click.option(
+    "--worker_init",
+    help="run initialization code in each worker process with --processes.",
+    multiple=True,
+)
 @click.option("--raw", "-r", help="raw output.", is_flag=True)
 @click.option(
     "--input",
@@ -35,6 +40,39 @@ from .main import jf
     help="output format (json, yaml, excel, csv, ...)",
     default="json",
 )
+@click.option(
+    "--read_concurrency",
+    help="Number of input files to read at the same time.",
+    default=1,
+)
+@click.option(
+    "--unordered_input",
+    help="with --read_concurrency, yield records as they are read instead of in file order.",
+    is_flag=True,
+)
+@click.option(
+    "--source_field", help="store the name of the input file to this field of each item."
+)
+@click.option(
+    "--vectorize",
+    help="evaluate arithmetic and comparison stages on columns of many items at a time with numpy (single process only).",
+    is_flag=True,
+)
+@click.option(
+    "--unordered",
+    help="with --processes, output the items as they are ready instead of in input order.",
+    is_flag=True,
+)
+@click.option(
+    "--reorder_window",
+    help="with --processes, allow the items to be output at most this many items out of input order.",
+    default=0,
+)
+@click.option(
+    "--start_method",
+    help="how to start the worker processes with --processes (fork, spawn or forkserver).",
+    type=click.Choice(["fork", "spawn", "forkserver"]),
+)
 @click.argument("query_and_files", nargs=-1, default=None)
 def main(
     processes,
@@ -49,6 +87,14 @@ def main(
     debug,
     raw,
     init,
+    worker_init,
+    read_concurrency,
+    unordered_input,
+    source_field,
+    vectorize,
+    unordered,
+    reorder_window,
+    start_method,
 ):
     return jf(
         processes,
@@ -63,6 +109,13 @@ def main(
         debug,
         raw,
         init,
+        read_concurrency=read_concurrency,
+        ordered_input=not unordered_input,
+        source_field=source_field,
+        vectorize=vectorize,
+        reorder_window=float("inf") if unordered else reorder_window,
+        worker_init=worker_init,
+        start_method=start_method,
     )
 
 
@@ -10,6 +10,8 @@ class Flatten(JFTransformation):
     [{'a.0': 1, 'a.1': 2, 'a.2': 3, 'b.0.c': 1, 'c.d': 1}]
     """
 
+    stateless = True
+
     def _flatten(self, it, root=""):
         if not isinstance(it, dict):
             return it
@@ -42,6 +44,8 @@ class JfDel(JFTransformation):
     [1, 2, 3]
     """
 
+    stateless = True
+
     def _fn(self, arr):
         param = self.args[0](1).split(".")
         for item in arr:
@@ -60,12 +64,149 @@ class YieldFrom(JFTransformation):
     [1, 2, 3]
     """
 
+    stateless = True
+
     def _fn(self, arr):
         for items in arr:
             for val in self.args[0](items):
                 yield val
 
 
+class BatchMap(JFTransformation):
+    """Call a function with lists of items instead of one item at a time
+
+    batch_map(fn, field=None, into=None, size=64, timeout=None)
+
+    fn gets lists of up to size items, or of the values of their field (a dotted
+    path), and returns a result for each. The results replace the items, or are
+    stored to the field into of the items. With timeout, the items read so far are
+    also passed on when the first of them came in timeout seconds ago.
+
+    >>> list(BatchMap(lambda x: lambda it: [len(it)] * len(it), size=2)([1, 2, 3]))
+    [2, 2, 1]
+    >>> from jf.process import DotAccessible
+    >>> items = [DotAccessible({"a": {"b": 1}}), DotAccessible({"a": {"b": 2}})]
+    >>> list(BatchMap(lambda x: lambda v: [i * 10 for i in v], field="a.b", into="c")(items))
+    [{'a': {'b': 1}, 'c': 10}, {'a': {'b': 2}, 'c': 20}]
+    >>> list(BatchMap(lambda x: lambda v: [], field="a.b")(items))
+    Traceback (most recent call last):
+    ...
+    ValueError: batch_map function returned 0 results for 2 items
+    >>> import threading, time
+    >>> from itertools import count
+    >>> threads = threading.active_count()
+    >>> items = BatchMap(lambda x: lambda v: v, size=2, timeout=1)(count())
+    >>> next(items), items.close(), time.sleep(0.5), threading.active_count() == threads
+    (0, None, None, True)
+    >>> def slow():
+    ...     for i in range(6):
+    ...         time.sleep(0.05)
+    ...         yield i
+    >>> sizes = list(BatchMap(lambda x: lambda v: [len(v)] * len(v), size=100, timeout=0.12)(slow()))
+    >>> len(sizes), max(sizes) < 6
+    (6, True)
+    """
+
+    stateless = True
+
+    @property
+    def batch_size(self):
+        return self.kwargs.get("size", 64)
+
+    def _batches(self, arr, size, timeout):
+        from itertools import islice
+
+        if not timeout:
+            arr = iter(arr)
+            return iter(lambda: list(islice(arr, size)), [])
+        return self._timed_batches(arr, size, timeout)
+
+    def _timed_batches(self, arr, size, timeout):
+        import queue
+        import threading
+        from time import monotonic
+
+        items = queue.Queue(size)
+        done = object()
+        errors = []
+        # Set when the batches are no longer read, so that the reader does not wait
+        # for room in the queue forever
+        stop = threading.Event()
+
+        def put(it):
+            while not stop.is_set():
+                try:
+                    items.put(it, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for it in arr:
+                    if not put(it):
+                        return
+            except Exception as err:
+                errors.append(err)
+            finally:
+                put(done)
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            batch = []
+            while True:
+                try:
+                    wait = max(0, deadline - monotonic()) if batch else None
+                    it = items.get(timeout=wait)
+                except queue.Empty:
+                    yield batch
+                    batch = []
+                    continue
+                if it is done:
+                    break
+                if not batch:
+                    deadline = monotonic() + timeout
+                batch.append(it)
+                if len(batch) >= size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+
+    def _fn(self, arr):
+        from .process import DotAccessibleNone, dotaccessible
+
+        fn = self.args[0](1)
+        field = self.kwargs.get("field")
+        into = self.kwargs.get("into")
+        size = self.kwargs.get("size", 64)
+        for batch in self._batches(arr, size, self.kwargs.get("timeout")):
+            values = batch
+            if field:
+                values = []
+                for it in batch:
+                    for p in field.split("."):
+                        it = getattr(it, p)
+                    values.append(None if isinstance(it, DotAccessibleNone) else it)
+            results = list(fn(values))
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"batch_map function returned {len(results)} results for {len(batch)} items"
+                )
+            if into:
+                for it, result in zip(batch, results):
+                    it = dotaccessible(it)
+                    it[into] = result
+                    yield it
+            else:
+                yield from results
+
+
 class GroupBy(JFTransformation):
     """Group items by value
 
@@ -1,55 +1,425 @@
+import io
 import json
-from jf.process import DotAccessible, undotaccessible
+import logging
+from itertools import chain, islice
+from jf.process import DotAccessible, DotAccessibleNone, undotaccessible
 
+log = logging.getLogger("jf")
 
-def yield_json_and_json_lines(inp):
+BATCH_SIZE = 1024
+SHARD_SIZE = 16 << 20
+MIN_SHARD_SIZE = 1 << 20
+PANDAS_EXT = (
+    "csv",
+    "xlsx",
+    "feather",
+    "fwf",
+    "gbq",
+    "hdf",
+    "html",
+    "orc",
+    "parquet",
+    "pickle",
+    "sas",
+    "spss",
+    "sql",
+    "stata",
+    "xml",
+)
+PANDAS_FMT_MAP = {"xlsx": "excel"}
+PANDAS_CHUNKED_EXT = ("csv", "fwf", "sas", "stata")
+PYARROW_DATASET_EXT = ("parquet", "feather")
+HTTP_CHUNK_SIZE = 1 << 16
+HTTP_RETRIES = 3
+HTTP_TIMEOUT = 60
+FETCH_CONCURRENCY = 4
+CODEC_MAGIC = {
+    b"\x1f\x8b": "gz",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zst",
+}
+
+
+def yield_json_and_json_lines(
+    inp, decode=False, batch=0, prefilter=None, fields=None, lazy=None, name=None
+):
     """Yield json and json lines
 
     Split potentially huge json strings into lines or components for low memory data processing.
+    The input can be a single buffer (bytes, bytearray, memoryview, mmap) which is scanned in
+    place, or an iterable of str or bytes chunks such as an open file.
 
-    Notice: Results are still json strings, so you most likely want to json.loads them.
+    Notice: Results are still json strings, unless decode is set. Then the records are decoded
+    while scanning and malformed records are skipped, and counted in a warning about the input
+    name once it is read (see report_malformed). With batch > 0 the results are yielded as
+    lists of up to batch records. Records not matching prefilter (see json_prefilter) are
+    skipped before decoding. fields and lazy are passed to jsonlgen.gen to decode only some
+    fields of object records, or to decode them as they are read.
 
+    >>> list(yield_json_and_json_lines(b'[{"a": 1}, {"b": 2}]'))
+    ['{"a": 1}', '{"b": 2}']
+    >>> list(yield_json_and_json_lines([b'{"a": 1}\\n{"b"', b': 2}\\n']))
+    ['{"a": 1}', '{"b": 2}']
+    >>> list(yield_json_and_json_lines(b'{"a": 1}\\n{"a": }\\n{"b": 2}', decode=True))
+    [{'a': 1}, {'b': 2}]
+    >>> list(yield_json_and_json_lines(b'{"a": 1} {"a": 2} {"a": 3}', decode=True, batch=2))
+    [[{'a': 1}, {'a': 2}], [{'a': 3}]]
+    >>> list(yield_json_and_json_lines(b'{"a": "x"} {"a": "y"}', prefilter=[[b'"y"']]))
+    ['{"a": "y"}']
+    >>> list(yield_json_and_json_lines(b'{"a": {"b": 1, "c": 2}, "d": 3}', True, fields={"a": {"b": None}}))
+    [{'a': {'b': 1}}]
     """
     from . import jsonlgen
 
-    return jsonlgen.gen(iter(inp))
+    gen = jsonlgen.gen(
+        inp, decode=decode, batch=batch, prefilter=prefilter, fields=fields, lazy=lazy
+    )
+    return report_malformed(gen, name) if decode else gen
 
 
-class MinimalAdapter:
+def report_malformed(gen, name=None):
     """
-    >>> a = MinimalAdapter()
-    >>> a(iter([b"abcde", b"fghij"])).read(2)
-    'ab'
-    >>> a.read(2)
-    'cd'
-    >>> a.read(2)
-    'ef'
+    Yield from a decoding jsonlgen.gen, and log the number of malformed records it
+    skipped: a warning if there were any, and with --debug also if there were none
+
+    >>> from jf import jsonlgen
+    >>> list(report_malformed(jsonlgen.gen(b'{"a": 1}\\n{"a": }', decode=True), "a.json"))
+    [{'a': 1}]
     """
+    yield from gen
+    name = name or "the input"
+    if gen.errors:
+        log.warning("jf: skipped %d malformed json records in %s", gen.errors, name)
+    else:
+        log.debug("jf: no malformed json records in %s", name)
 
-    def __init__(self):
-        self._fip = None
-        self._buf = None  # storage of read but unused material, maximum one line
 
-    def __call__(self, fip):
-        self._fip = fip  # store for future use
-        self._buf = ""
-        return self
+def json_options(pushdown):
+    """
+    Arguments of yield_json_and_json_lines for decoding json with pushdown
 
-    def read(self, size):
-        if len(self._buf) >= size:
-            # enough in buffer from last read, just cut it off and return
-            tmp, self._buf = self._buf[:size], self._buf[size:]
-            return tmp
-        for line in self._fip:
-            self._buf += line.decode()
-            if len(self._buf) > size:
-                break
-        else:
-            # ran out of lines, return what we have
-            tmp, self._buf = self._buf, ""
-            return tmp
-        tmp, self._buf = self._buf[:size], self._buf[size:]
-        return tmp
+    Only the fields the query reads are decoded. If they are not known but the query starts
+    with filters which only read fields, the records are decoded lazily (see LazyRecord).
+    """
+    from .process import LazyRecord
+
+    pushdown = pushdown or {}
+    fields = pushdown.get("paths")
+    return {
+        "prefilter": json_prefilter(pushdown.get("filters")),
+        "fields": fields,
+        "lazy": LazyRecord if fields is None and pushdown.get("lazy") else None,
+    }
+
+
+def json_prefilter(filters):
+    """
+    Byte strings that the json of records passing filters contains
+
+    filters are from query_parser.filter_predicates. Only string equality and containment
+    give byte strings, so None is returned if an alternative of filters has neither.
+
+    >>> json_prefilter([[("a", "==", "x"), ("b", "in", ["y", "z"])], [("c", "contains", 'q"')]])
+    [[b'"x"', b'"y"'], [b'"x"', b'"z"'], [b'q\\\\"']]
+    >>> json_prefilter([[("a", "==", "x")], [("b", ">", 1)]]) is None
+    True
+    """
+    if not filters:
+        return None
+    ret = []
+    for conjuncts in filters:
+        alternatives = [[]]
+        for field, op, value in conjuncts:
+            if op == "==" and isinstance(value, str):
+                needles = [json.dumps(value, ensure_ascii=False)]
+            elif op == "in" and value and all(isinstance(it, str) for it in value):
+                needles = [json.dumps(it, ensure_ascii=False) for it in value]
+            elif op == "contains" and isinstance(value, str):
+                needles = [json.dumps(value, ensure_ascii=False)[1:-1]]
+            else:
+                continue
+            alternatives = [
+                alt + [needle.encode("utf-8", "surrogatepass")]
+                for alt in alternatives
+                for needle in needles
+            ]
+        if alternatives == [[]]:
+            return None
+        ret.extend(alternatives)
+    return ret if len(ret) <= 64 else None
+
+
+def batched(it, n):
+    """Group items into lists of n items
+
+    >>> list(batched(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    it = iter(it)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+def read_chunks(f, size=1 << 20):
+    """Read a binary file in fixed size chunks
+
+    Unlike iterating lines, this keeps the memory use bounded also for huge single line json
+    documents.
+
+    >>> from io import BytesIO
+    >>> list(read_chunks(BytesIO(b"abcde"), 2))
+    [b'ab', b'cd', b'e']
+    """
+    return iter(lambda: f.read(size), b"")
+
+
+def detect_codec(f):
+    """Detect the compression of a binary file from its magic bytes
+
+    Returns gz, bz2, xz, zst or None. The file must support peek, which open(fn, "rb")
+    and sys.stdin.buffer do.
+
+    >>> import gzip, io
+    >>> detect_codec(io.BufferedReader(io.BytesIO(gzip.compress(b'{"a": 1}'))))
+    'gz'
+    >>> detect_codec(io.BufferedReader(io.BytesIO(b'{"a": 1}'))) is None
+    True
+    """
+    if not hasattr(f, "peek"):
+        return None
+    head = f.peek(max(map(len, CODEC_MAGIC)))
+    for magic, codec in CODEC_MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def decompressed(f, codec):
+    """Decompressing file object reading the compressed binary file f"""
+    if codec == "gz":
+        import gzip
+
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if codec == "bz2":
+        import bz2
+
+        return bz2.BZ2File(f)
+    if codec == "xz":
+        import lzma
+
+        return lzma.LZMAFile(f)
+    if codec == "zst":
+        try:
+            import zstandard
+        except ImportError as err:
+            raise ImportError("Reading zstd compressed input requires zstandard") from err
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    raise NotImplementedError(f"Unknown compression {codec}")
+
+
+def prefetched(source, prefetch=4):
+    """Iterate source() in a background thread, at most prefetch items ahead
+
+    >>> list(prefetched(lambda: iter([b"a", b"b"])))
+    [b'a', b'b']
+    """
+    return concurrent_batches([source], 1, prefetch=prefetch)
+
+
+def input_chunks(f):
+    """Input of a binary file for the json scanner
+
+    Compressed files are decompressed in a background thread, so that decompression
+    overlaps with parsing. Other files are memory mapped if possible and read in chunks
+    otherwise.
+
+    >>> import gzip, io
+    >>> f = io.BufferedReader(io.BytesIO(gzip.compress(b'{"a": 1}')))
+    >>> list(yield_json_and_json_lines(input_chunks(f), decode=True))
+    [{'a': 1}]
+    """
+    codec = detect_codec(f)
+    if codec:
+        return prefetched(lambda: read_chunks(decompressed(f, codec)))
+    mapped = map_file(f)
+    return read_chunks(f) if mapped is None else mapped
+
+
+def map_file(f):
+    """Memory map a local file for reading
+
+    Returns None for files that cannot be mapped, like pipes and empty files. The mapping is
+    scanned in place and closed when the last reference to it is dropped.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryFile() as tmpfile:
+    ...     map_file(tmpfile) is None
+    ...     tmpfile.write(b'{"a": 1}') and True
+    ...     tmpfile.flush()
+    ...     map_file(tmpfile)[:]
+    True
+    True
+    b'{"a": 1}'
+    """
+    import io
+    import mmap
+
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return None
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def read_shard(shard):
+    """Read the records of a byte range of a jsonl file
+
+    shard is (filename, start, end, options), where options are keyword arguments of
+    yield_json_and_json_lines. Both ends of the range are moved forward
+    to the start of the next line, so that consecutive ranges split the file exactly at
+    line boundaries.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as tmpfile:
+    ...     tmpfile.write(b'{"a": 1}\\n{"a": 2}\\n{"a": 3}\\n') and True
+    ...     tmpfile.flush()
+    ...     read_shard((tmpfile.name, 0, 5, None)), read_shard((tmpfile.name, 5, 27, None))
+    True
+    ([{'a': 1}], [{'a': 2}, {'a': 3}])
+    """
+    fn, start, end, options = shard
+    with open(fn, "rb") as f:
+        mapped = map_file(f)
+    if mapped is None:
+        return []
+    size = len(mapped)
+    if start > 0:
+        start = mapped.find(b"\n", start - 1) + 1 or size
+    if end < size:
+        end = mapped.find(b"\n", end - 1) + 1 or size
+    view = memoryview(mapped)[start:end]
+    try:
+        return list(
+            yield_json_and_json_lines(view, decode=True, name=fn, **(options or {}))
+        )
+    finally:
+        view.release()
+
+
+class JsonlShards:
+    """
+    Local jsonl file split into byte ranges which are parsed independently
+
+    With multiprocessing each worker parses its own ranges, so that the records are not
+    parsed in the parent and pickled to the workers. Iterating yields the records in
+    batches as data_input(..., batch=N) does.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile(suffix=".jsonl") as tmpfile:
+    ...     tmpfile.write(b'{"a": 1}\\n{"a": 2}\\n{"a": 3}\\n') and True
+    ...     tmpfile.flush()
+    ...     shards = JsonlShards(tmpfile.name, shard_size=10)
+    ...     [shard[1:3] for shard in shards.shards()]
+    ...     list(shards)
+    True
+    [(0, 10), (10, 20), (20, 27)]
+    [[{'a': 1}, {'a': 2}], [{'a': 3}]]
+    """
+
+    def __init__(self, fn, shard_size=SHARD_SIZE, options=None):
+        import os
+
+        self.fn = fn
+        self.size = os.path.getsize(fn)
+        self.shard_size = max(1, shard_size)
+        self.options = options
+
+    def shards(self):
+        for start in range(0, self.size, self.shard_size):
+            end = min(start + self.shard_size, self.size)
+            yield self.fn, start, end, self.options
+
+    def __iter__(self):
+        return filter(None, map(read_shard, self.shards()))
+
+
+def jsonl_shards(files, inputfmt=None, processes=1, pushdown=None):
+    """
+    Split the input to byte ranges if it is a single local, uncompressed jsonl file
+
+    Returns None when the input cannot be split. See json_options for pushdown.
+    """
+    import os
+
+    if not files or len(files) != 1 or "://" in files[0]:
+        return None
+    fn = files[0]
+    fmt = inputfmt if inputfmt is not None else fn.split(".")[-1]
+    if fmt != "jsonl" or not os.path.isfile(fn):
+        return None
+    with open(fn, "rb") as f:
+        if detect_codec(f):
+            return None
+    size = os.path.getsize(fn)
+    # a few shards per process to balance the load
+    shard_size = min(SHARD_SIZE, max(MIN_SHARD_SIZE, size // (4 * processes)))
+    return JsonlShards(fn, shard_size, json_options(pushdown))
+
+
+def yaml_records(f):
+    """
+    Yield the records of a yaml stream one at a time
+
+    Each document is a record, except that the items of a document which is a sequence
+    are records. Records are composed and constructed one at a time, so the whole input
+    is never in memory. The stream is parsed with libyaml when it is available.
+
+    >>> from io import BytesIO
+    >>> list(yaml_records(BytesIO(b"- a: 1\\n- a: &x 2\\n- b: *x\\n---\\nc: 3\\n---\\n4\\n")))
+    [{'a': 1}, {'a': 2}, {'b': 2}, {'c': 3}, 4]
+    """
+    import yaml
+    from yaml.composer import Composer
+    from yaml.constructor import SafeConstructor
+    from yaml.resolver import Resolver
+
+    if yaml.__with_libyaml__:
+        from yaml.cyaml import CParser
+
+        class Loader(CParser, Composer, SafeConstructor, Resolver):
+            # The C parser composes whole documents only, so the nodes are composed
+            # from its events in python
+            def __init__(self, stream):
+                CParser.__init__(self, stream)
+                Composer.__init__(self)
+                SafeConstructor.__init__(self)
+                Resolver.__init__(self)
+
+    else:
+        Loader = yaml.SafeLoader
+
+    loader = Loader(f)
+    try:
+        loader.get_event()
+        while not loader.check_event(yaml.StreamEndEvent):
+            loader.get_event()
+            if loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                yield loader.construct_document(loader.compose_node(None, None))
+            loader.get_event()
+            loader.anchors = {}
+    finally:
+        loader.dispose()
 
 
 def get_handler(method, fntype, additionals):
@@ -59,22 +429,131 @@ def get_handler(method, fntype, additionals):
             return getattr(it, fnname)
 
 
-def fetch_http(url):
-    import requests
+def http_session():
+    """Session shared by all http requests, so that connections are kept alive and reused"""
+    global _http_session
+    if _http_session is None:
+        import requests
 
-    return lambda url: requests.get(url).content
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=2 * FETCH_CONCURRENCY)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = session
+    return _http_session
 
 
-def fetch_https(url):
+_http_session = None
+
+
+def http_chunks(url, chunk_size=HTTP_CHUNK_SIZE, retries=HTTP_RETRIES):
+    """
+    Yield the body of an http(s) url in chunks as they arrive
+
+    If the connection breaks, the rest of the body is requested with a Range header, at
+    most retries times. A server which ignores the range sends the whole body again and
+    the part already received is skipped, unless the body has changed.
+    """
     import requests
 
-    return lambda url: requests.get(url).content
+    received, validator, encoded = 0, None, False
+    for attempt in range(retries + 1):
+        headers = {}
+        if received:
+            headers["Range"] = f"bytes={received}-"
+            if validator:
+                headers["If-Range"] = validator
+        with http_session().get(
+            url, headers=headers, stream=True, timeout=HTTP_TIMEOUT
+        ) as resp:
+            resp.raise_for_status()
+            tag = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+            skip = 0
+            if not received:
+                validator = tag
+                encoded = resp.headers.get("Content-Encoding", "identity") != "identity"
+            elif resp.status_code != 206:
+                if not validator or tag != validator:
+                    raise IOError(f"{url} changed while reading it")
+                skip = received
+            try:
+                for chunk in resp.iter_content(chunk_size):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk, skip = chunk[skip:], 0
+                    received += len(chunk)
+                    yield chunk
+                return
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ):
+                # Ranges of a compressed body are not known after decompression
+                if attempt == retries or encoded:
+                    raise
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Binary file object reading an iterable of bytes chunks
+
+    >>> io.BufferedReader(ChunkReader([b"ab", b"", b"cde"])).read()
+    b'abcde'
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+
+def open_input(fn):
+    """
+    Open a local file or an http(s) url as a binary file
+
+    urls are streamed: the body is downloaded in a background thread while it is read.
+    """
+    if fn.split("://")[0] in ("http", "https"):
+        source = prefetched(lambda: http_chunks(fn))
+        return io.BufferedReader(ChunkReader(source), HTTP_CHUNK_SIZE)
+    return open(fn, "rb")
+
+
+def fetch_http(url):
+    return http_chunks
+
+
+def fetch_https(url):
+    return http_chunks
 
 
 def fetch_file(fn, f, additionals):
     """
     Fetch file with custom handler
 
+    Handlers return the contents of the file, or an iterable of chunks of it.
+
     >>> from io import StringIO
     >>> s = StringIO()
     >>> class fetch_mod:
@@ -92,17 +571,35 @@ def fetch_file(fn, f, additionals):
     except Exception as ex:
         fun = get_handler(proto, "fetch", additionals)
     if fun:
-        f.write(fun(fn))
+        ret = fun(fn)
+        if isinstance(ret, (bytes, str)):
+            f.write(ret)
+        else:
+            for chunk in ret:
+                f.write(chunk)
         return
     raise NotImplementedError(
         f"I do not know how to fetch {proto}://.\nPlease implement {proto}(url) -> bytes and import a module with it with --import"
     )
 
 
-def data_input(files=None, additionals={}, inputfmt=None, listen=None):
+def data_input(
+    files=None,
+    additionals={},
+    inputfmt=None,
+    listen=None,
+    batch=0,
+    concurrency=1,
+    ordered=True,
+    source_field=None,
+    pushdown=None,
+):
     """
     Data input function
 
+    Yields the input records, or lists of up to batch records if batch is given.
+    See data_batches for reading several files concurrently.
+
     >>> import tempfile
     >>> with tempfile.NamedTemporaryFile() as tmpfile:
     ...     tmpfile.write(b'[{"myconfig": "myvalue"}]') and True
@@ -127,126 +624,436 @@ def data_input(files=None, additionals={}, inputfmt=None, listen=None):
     Traceback (most recent call last):
     ...
     NotImplementedError: ...
+    >>> with tempfile.NamedTemporaryFile(suffix=".jsonl") as tmpfile:
+    ...     tmpfile.write(b'{"a": 1}\\n{"a": 2}\\n{"a": 3}\\n') and True
+    ...     tmpfile.flush()
+    ...     list(data_input([tmpfile.name], batch=2))
+    True
+    [[{'a': 1}, {'a': 2}], [{'a': 3}]]
     """
-    import fileinput
-    import json
-    import sys
-
-    pandas_ext = (
-        "csv",
-        "xlsx",
-        "feather",
-        "fwf",
-        "gbq",
-        "hdf",
-        "html",
-        "orc",
-        "parquet",
-        "pickle",
-        "sas",
-        "spss",
-        "sql",
-        "stata",
-        "xml",
+    batches = data_batches(
+        files,
+        additionals,
+        inputfmt,
+        listen,
+        batch or BATCH_SIZE,
+        concurrency,
+        ordered,
+        source_field,
+        pushdown,
     )
-    pandas_fmt_map = {"xlsx": "excel"}
+    return batches if batch else chain.from_iterable(batches)
 
-    def try_json_loads(it):
-        try:
-            return json.loads(it)
-        except Exception as ex:
-            pass
+
+def data_batches(
+    files=None,
+    additionals={},
+    inputfmt=None,
+    listen=None,
+    batch=BATCH_SIZE,
+    concurrency=1,
+    ordered=True,
+    source_field=None,
+    pushdown=None,
+):
+    """
+    Yield the input records as lists of up to batch records
+
+    With concurrency > 1 up to that many files are opened, decompressed and parsed at
+    the same time (see concurrent_batches). If source_field is given, the name of the
+    input file is stored to that field of each record. pushdown lets readers skip the
+    columns and rows the query does not need (see pandas_batches). Several urls are
+    fetched at least FETCH_CONCURRENCY at a time.
+    """
+    import sys
+
+    if source_field and pushdown:
+        # The source field is not in the input
+        filters = [
+            [it for it in conjuncts if it[0] != source_field]
+            for conjuncts in pushdown.get("filters") or []
+        ]
+        # and it is stored to the records as they are read, which lazy ones are not
+        pushdown = dict(pushdown, filters=filters or None, lazy=False)
 
     tmpf = None
     if not files:
         if listen:
             return int(listen)
-        if inputfmt is None or inputfmt.startswith("json"):
-            yield from filter(
-                lambda x: x, map(try_json_loads, yield_json_and_json_lines(sys.stdin))
-            )
+        stdin = getattr(sys.stdin, "buffer", sys.stdin)
+        fmt, kwargs = parse_inputfmt(inputfmt or "json")
+        if fmt.startswith("json") or fmt in ("yml", "yaml") + PANDAS_CHUNKED_EXT:
+            if fmt.startswith("json"):
+                batches = yield_json_and_json_lines(
+                    input_chunks(stdin),
+                    decode=True,
+                    batch=batch,
+                    name="<stdin>",
+                    **json_options(pushdown),
+                )
+            elif fmt in ("yml", "yaml"):
+                batches = batched(yaml_records(stdin), batch)
+            else:
+                batches = pandas_batches(stdin, fmt, kwargs, batch)
+            if source_field:
+                batches = tag_source(batches, source_field, "<stdin>")
+            yield from batches
             return
         else:
+            import shutil
             from tempfile import NamedTemporaryFile
 
             tmpf = NamedTemporaryFile(
-                suffix=f".{pandas_fmt_map.get(inputfmt, inputfmt)}", delete=False
+                suffix=f".{PANDAS_FMT_MAP.get(fmt, fmt)}", delete=False
             )
-            for line in sys.stdin:
-                tmpf.write(line.encode())
+            shutil.copyfileobj(stdin, tmpf)
             tmpf.close()
             files = [tmpf.name]
 
+    def source(fn):
+        def _batches():
+            batches = file_batches(fn, additionals, inputfmt, batch, pushdown)
+            if source_field:
+                batches = tag_source(batches, source_field, "<stdin>" if tmpf else fn)
+            return batches
+
+        return _batches
+
+    remote = sum("://" in fn for fn in files)
+    if remote > 1:
+        # Downloads wait for the network, so fetch a few at a time in any case
+        concurrency = max(concurrency, min(remote, FETCH_CONCURRENCY))
     try:
-        for fn in files:
-            inputfmt = fn.split(".")[-1] if inputfmt is None else inputfmt
-            inputfmt = inputfmt.split(",", 1)
-            inputfmt, inputkwargs = (
-                inputfmt[0],
-                inputfmt[1] if len(inputfmt) == 2 else "",
-            )
-            inputkwargs = (
-                dict([it.split("=") for it in inputkwargs.split(",")])
-                if len(inputkwargs)
-                else {}
-            )
-            if "://" in fn:
-                from tempfile import NamedTemporaryFile
-
-                ext = fn.split(".")[-1]
-                if not len(ext) in (2, 3, 4):
-                    ext = "json"
-                tmpf = NamedTemporaryFile(suffix=f".{ext}", delete=False)
-                fn = fetch_file(fn, tmpf, additionals)
-                tmpf.close()
-                fn = tmpf.name
-            if inputfmt in pandas_ext:
-                import pandas
-
-                df = getattr(pandas, f"read_{pandas_fmt_map.get(inputfmt, inputfmt)}")(
-                    fn, **inputkwargs
-                )
-                for it in df.to_dict(orient="records"):
-                    yield it
-                continue
-            if inputfmt in ("yml", "yaml"):
-                import yaml
-
-                ma = MinimalAdapter()
-                with fileinput.input(fn, mode="rb") as f:
-                    ret = yaml.safe_load(ma(f))
-                    if isinstance(ret, list):
-                        yield from ret
-                    else:
-                        yield ret
+        sources = [source(fn) for fn in files]
+        if concurrency > 1 and len(sources) > 1:
+            yield from concurrent_batches(sources, concurrency, ordered)
+        else:
+            for it in sources:
+                yield from it()
+    finally:
+        if tmpf:
+            import os
+
+            os.unlink(tmpf.name)
+            tmpf = None
+
+
+def parse_inputfmt(inputfmt):
+    """
+    Split input format and its keyword arguments
+
+    >>> parse_inputfmt("csv,sep=;,header=None")
+    ('csv', {'sep': ';', 'header': 'None'})
+    """
+    inputfmt = inputfmt.split(",", 1)
+    inputfmt, inputkwargs = (
+        inputfmt[0],
+        inputfmt[1] if len(inputfmt) == 2 else "",
+    )
+    inputkwargs = (
+        dict([it.split("=") for it in inputkwargs.split(",")])
+        if len(inputkwargs)
+        else {}
+    )
+    return inputfmt, inputkwargs
+
+
+def pyarrow_filter(filters, schema):
+    """
+    Convert filters from query_parser.filter_predicates to a pyarrow expression
+
+    Comparisons on fields missing from the schema, or with literals of a different
+    type than the field, are left out. As leaving out a comparison only lets more
+    rows through, the expression still keeps every row that passes the query.
+
+    >>> import pytest
+    >>> pa = pytest.importorskip("pyarrow")
+    >>> import pyarrow.dataset as ds
+    >>> table = pa.table({"a": [0, 1, 2, 5, None], "b": ["x", "y", "z", "w", "v"]})
+    >>> expr = pyarrow_filter([[("a", ">", 1), ("b", "==", 1)], [("a", "in", [0])]], table.schema)
+    >>> ds.dataset(table).to_table(filter=expr).column("a").to_pylist()
+    [0, 2, 5]
+    >>> expr = pyarrow_filter([[("a", "!=", 2)]], table.schema)
+    >>> ds.dataset(table).to_table(filter=expr).column("a").to_pylist()
+    [0, 1, 5, None]
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    def compatible(typ, value):
+        if isinstance(value, list):
+            return all(compatible(typ, it) for it in value)
+        if isinstance(value, bool):
+            return pa.types.is_boolean(typ)
+        if isinstance(value, (int, float)):
+            return pa.types.is_integer(typ) or pa.types.is_floating(typ)
+        return pa.types.is_string(typ) or pa.types.is_large_string(typ)
+
+    def comparison(field, op, value):
+        f = ds.field(field)
+        if op == "in":
+            return f.isin(value)
+        if op == "!=":
+            # python keeps missing values for !=
+            return (f != value) | f.is_null()
+        return {
+            "==": f.__eq__,
+            "<": f.__lt__,
+            "<=": f.__le__,
+            ">": f.__gt__,
+            ">=": f.__ge__,
+        }[op](value)
+
+    ret = None
+    for conjuncts in filters:
+        expr = None
+        for field, op, value in conjuncts:
+            if (
+                op == "contains"
+                or field not in schema.names
+                or not compatible(schema.field(field).type, value)
+            ):
                 continue
-            if not inputfmt in ("json", "jsonl"):
-                fun = get_handler(fn.split(".")[-1], "unserialize", additionals)
-                if fun:
-                    with open(fn, "rb") as f:
-                        yield from fun(f)
-                        continue
+            part = comparison(field, op, value)
+            expr = part if expr is None else expr & part
+        if expr is None:
+            return None
+        ret = expr if ret is None else ret | expr
+    return ret
 
-            import os
 
-            ext = os.path.splitext(fn)[1]
-            with fileinput.input(
-                fn,
-                openhook=(fileinput.hook_compressed if ext in ("bz2", "gz") else None),
-                mode="rb",
-            ) as f:
-                yield from map(
-                    try_json_loads,
-                    yield_json_and_json_lines(map(lambda x: x.decode(), f)),
+def pandas_batches(f, inputfmt, inputkwargs={}, batch=BATCH_SIZE, pushdown=None):
+    """
+    Read a pandas supported format in lists of up to batch records
+
+    csv, fwf, sas and stata are read by pandas in chunks, and parquet and feather by
+    record batches with pyarrow, so that the whole input is never in memory at once.
+    Other formats are read by pandas as a whole.
+
+    With pushdown, a dict of the columns and filters (see query_parser.pushdown), only
+    the columns the query reads are read from parquet and feather, and record batches
+    (and parquet row groups) which cannot pass the filters are skipped. For json input
+    see json_options.
+
+    >>> from io import BytesIO
+    >>> list(pandas_batches(BytesIO(b"a,b\\n1,2\\n3,4\\n5,6\\n"), "csv", batch=2))
+    [[{'a': 1, 'b': 2}, {'a': 3, 'b': 4}], [{'a': 5, 'b': 6}]]
+    """
+    import pandas
+
+    if inputfmt in PYARROW_DATASET_EXT and not inputkwargs:
+        try:
+            import pyarrow.dataset
+        except ImportError:
+            pass
+        else:
+            dataset = pyarrow.dataset.dataset(f, format=inputfmt)
+            pushdown = pushdown or {}
+            columns = pushdown.get("columns")
+            if columns is not None:
+                columns = [it for it in dataset.schema.names if it in columns]
+            filters = pushdown.get("filters")
+            if filters:
+                filters = pyarrow_filter(filters, dataset.schema)
+            batches = dataset.to_batches(
+                columns=columns, filter=filters, batch_size=batch
+            )
+            for it in batches:
+                if it.num_rows:
+                    yield it.to_pandas().to_dict(orient="records")
+            return
+
+    reader = getattr(pandas, f"read_{PANDAS_FMT_MAP.get(inputfmt, inputfmt)}")
+    if inputfmt in PANDAS_CHUNKED_EXT:
+        chunks = reader(f, **dict({"chunksize": batch}, **inputkwargs))
+        try:
+            for df in chunks:
+                yield df.to_dict(orient="records")
+        finally:
+            chunks.close()
+        return
+    yield from batched(reader(f, **inputkwargs).to_dict(orient="records"), batch)
+
+
+def file_batches(fn, additionals={}, inputfmt=None, batch=BATCH_SIZE, pushdown=None):
+    """
+    Yield the records of a single input file as lists of up to batch records
+
+    The format is taken from the file extension unless inputfmt is given. See
+    pandas_batches for pushdown. http(s) urls are streamed, except for the pandas formats
+    which are downloaded to a temporary file first like other urls.
+    """
+    if inputfmt is None:
+        ext = fn.split(".")
+        if len(ext) > 2 and ext[-1] in CODEC_MAGIC.values():
+            ext.pop()
+        inputfmt = ext[-1]
+    inputfmt, inputkwargs = parse_inputfmt(inputfmt)
+    tmpf = None
+    try:
+        streamed = fn.split("://")[0] in ("http", "https") and inputfmt not in PANDAS_EXT
+        if "://" in fn and not streamed:
+            from tempfile import NamedTemporaryFile
+
+            ext = fn.split(".")[-1]
+            if not len(ext) in (2, 3, 4):
+                ext = "json"
+            tmpf = NamedTemporaryFile(suffix=f".{ext}", delete=False)
+            fetch_file(fn, tmpf, additionals)
+            tmpf.close()
+            fn = tmpf.name
+        if inputfmt in PANDAS_EXT:
+            yield from pandas_batches(fn, inputfmt, inputkwargs, batch, pushdown)
+            return
+        if inputfmt in ("yml", "yaml"):
+            with open_input(fn) as f:
+                codec = detect_codec(f)
+                yield from batched(
+                    yaml_records(decompressed(f, codec) if codec else f), batch
                 )
-    except Exception as ex:
-        raise ex
+            return
+        if not inputfmt in ("json", "jsonl"):
+            fun = get_handler(fn.split(".")[-1], "unserialize", additionals)
+            if fun:
+                with open_input(fn) as f:
+                    yield from batched(fun(f), batch)
+                    return
+
+        with open_input(fn) as f:
+            yield from yield_json_and_json_lines(
+                input_chunks(f),
+                decode=True,
+                batch=batch,
+                name=fn,
+                **json_options(pushdown),
+            )
     finally:
         if tmpf:
             import os
 
             os.unlink(tmpf.name)
-            tmpf = None
+
+
+def tag_source(batches, field, name):
+    """
+    Store the input name to a field of each record
+
+    >>> list(tag_source([[{"a": 1}, 2]], "file", "a.json"))
+    [[{'a': 1, 'file': 'a.json'}, 2]]
+    """
+    for batch in batches:
+        for it in batch:
+            if isinstance(it, dict):
+                it[field] = name
+        yield batch
+
+
+class _Failure:
+    def __init__(self, ex):
+        self.ex = ex
+
+
+_DONE = object()
+
+
+def _put(q, item, stop):
+    """Put item to queue q unless stop is set before there is room for it"""
+    import queue
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _pump(source, out, stop):
+    """Move items from source() to the queue out until done or stopped"""
+    try:
+        for item in source():
+            if not _put(out, item, stop):
+                return False
+    except BaseException as ex:
+        _put(out, _Failure(ex), stop)
+        return False
+    return True
+
+
+def concurrent_batches(sources, concurrency=4, ordered=True, prefetch=4):
+    """
+    Read several sources at the same time in background threads
+
+    Sources are callables returning iterables. At most concurrency sources are read at a
+    time and each of them is read at most prefetch items ahead of the consumer. In
+    ordered mode the items of the sources are yielded in the order of the sources, otherwise
+    in the order they become available.
+
+    >>> sources = [lambda: [[1], [2]], lambda: [[3]], lambda: [[4], [5]]]
+    >>> list(concurrent_batches(sources, 2))
+    [[1], [2], [3], [4], [5]]
+    >>> sorted(concurrent_batches(sources, 2, ordered=False))
+    [[1], [2], [3], [4], [5]]
+    """
+    import queue
+    import threading
+    from collections import deque
+
+    stop = threading.Event()
+    sources = iter(sources)
+
+    def start(target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def get(q):
+        item = q.get()
+        if isinstance(item, _Failure):
+            raise item.ex
+        return item
+
+    try:
+        if ordered:
+
+            def read(source, q):
+                if _pump(source, q, stop):
+                    _put(q, _DONE, stop)
+
+            pending = deque()
+            for source in islice(sources, concurrency):
+                pending.append(queue.Queue(prefetch))
+                start(read, source, pending[-1])
+            while pending:
+                q = pending.popleft()
+                yield from iter(lambda: get(q), _DONE)
+                for source in islice(sources, 1):
+                    pending.append(queue.Queue(prefetch))
+                    start(read, source, pending[-1])
+        else:
+            lock = threading.Lock()
+            q = queue.Queue(prefetch * concurrency)
+
+            def read_all():
+                while True:
+                    with lock:
+                        source = next(sources, None)
+                    if source is None:
+                        _put(q, _DONE, stop)
+                        return
+                    if not _pump(source, q, stop):
+                        return
+
+            for _ in range(concurrency):
+                start(read_all)
+            running = concurrency
+            while running:
+                item = get(q)
+                if item is _DONE:
+                    running -= 1
+                else:
+                    yield item
+    finally:
+        stop.set()
 
 
 def write_bytes(barr):
@@ -343,11 +1150,8 @@ def get_supported_formats():
 
 
 def not_dotaccessible(it):
-    if isinstance(it, dict):
-        return {k: not_dotaccessible(v) for k, v in dict.items(it)}
-    if isinstance(it, list):
-        return [not_dotaccessible(v) for v in it]
-    return it
+    """Item with its DotAccessible dicts copied to dicts, see undotaccessible"""
+    return undotaccessible(it)
 
 
 class StructEncoder(json.JSONEncoder):
@@ -361,8 +1165,8 @@ class StructEncoder(json.JSONEncoder):
     """
 
     def default(self, obj):
-        if isinstance(obj, DotAccessible):
-            obj = {k: v for k, v in dict.items(obj)}
+        if isinstance(obj, DotAccessibleNone):
+            return None
         try:
             return super().default(obj)
         except:
@@ -408,12 +1212,12 @@ def print_results(ret, output, compact=False, raw=False, additionals={}):
     NotImplementedError: Cannot output not supported yet. Please consider making a PR!
     """
     import sys
-    from pygments.lexers import get_lexer_by_name
-    from pygments import highlight
-    from pygments.formatters import TerminalFormatter
 
     if output == "yaml":
         import yaml
+
+        yaml.add_representer(DotAccessible, yaml.Dumper.represent_dict)
+        yaml.add_representer(DotAccessibleNone, lambda d, _: d.represent_none(None))
     if output == "help":
         import yaml
 
@@ -422,12 +1226,17 @@ def print_results(ret, output, compact=False, raw=False, additionals={}):
 
     _highligh = None
     try:
-        formatter = TerminalFormatter()
         lexertype = output if output != "jsonl" else "json"
         output_kwargs = {}
         if not compact:
             output_kwargs["indent"] = 2
         if sys.stdout.isatty():
+            # pygments is slow to import, so only import it for highlighting
+            from pygments.lexers import get_lexer_by_name
+            from pygments import highlight
+            from pygments.formatters import TerminalFormatter
+
+            formatter = TerminalFormatter()
             lexer = get_lexer_by_name(lexertype, stripall=True)
             _highligh = lambda line: highlight(line, lexer, formatter).rstrip()
     except:
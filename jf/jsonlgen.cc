@@ -1,40 +1,86 @@
 #include <Python.h> 
 #include <string>
 #include <iostream>
-#include <sstream>
-#include <queue>
 #include <vector>
+#include <new>
+#include <unordered_map>
 
 #define DEBUG (0)
+#define MAX_INTERNED_KEYS (4096)
+#define MAX_DEPTH (1000)
+#define DEFAULT_BATCH (1024)
 
 using namespace std;
 
 typedef struct {
     PyObject_HEAD
     PyObject *iter;
-    queue<string> items;
+    Py_buffer view;
+    bool has_view = 0;
+    Py_ssize_t view_pos = 0;
     vector<char> data;
+    Py_ssize_t head = 0;
+    Py_ssize_t data_pos = 0;
     bool quote = 0;
     bool escape = 0;
     uint8_t obj = 0;
     uint8_t list = 0;
-    int item = -1;
-    int pos = -1;
+    Py_ssize_t item = -1;
+    bool decode = 0;
+    bool strict = 0;
+    Py_ssize_t batch = 0;
+    Py_ssize_t errors = 0;
+    unordered_map<string, PyObject *> keys;
+    vector<vector<string> > prefilter;
+    bool prefilter_ascii = 1;
+    PyObject *fields;
+    PyObject *lazy;
 } JSONLgenState;
 
+static void
+jsonlgen_release(JSONLgenState *jfstate)
+{
+    if (jfstate->has_view) {
+        PyBuffer_Release(&jfstate->view);
+        jfstate->has_view = 0;
+    }
+    Py_CLEAR(jfstate->iter);
+}
+
+static void
+jsonlgen_clear_keys(JSONLgenState *jfstate)
+{
+    for (auto &it : jfstate->keys)
+        Py_DECREF(it.second);
+    jfstate->keys.clear();
+}
+
 static void
 jsonlgen_dealloc(JSONLgenState *jfstate)
 {
-    Py_XDECREF(jfstate->iter);
+    jsonlgen_release(jfstate);
+    jsonlgen_clear_keys(jfstate);
+    Py_CLEAR(jfstate->fields);
+    Py_CLEAR(jfstate->lazy);
+    jfstate->keys.~unordered_map<string, PyObject *>();
+    jfstate->prefilter.~vector<vector<string> >();
+    jfstate->data.~vector<char>();
     Py_TYPE(jfstate)->tp_free(jfstate);
 }
 
 
-void parsejsonl(string &str, JSONLgenState *s){
-    for(char& c : str){
-        s->pos++;
-        s->data.push_back(c);
-        if(DEBUG) cerr << c << " " << s->quote << s->escape << (int) s->obj << (int) s->list << " " << s->pos << " " << s->data.size() << endl;
+/* Scan buf[*pos:len] until the next complete item.
+ *
+ * Offsets are relative to buf, so the same state machine is used both for
+ * scanning a caller's buffer in place and for the internal data buffer.
+ */
+static bool
+scan_next(JSONLgenState *s, const char *buf, Py_ssize_t len, Py_ssize_t *pos,
+          Py_ssize_t *start, Py_ssize_t *end)
+{
+    while (*pos < len) {
+        const char c = buf[*pos];
+        const Py_ssize_t p = (*pos)++;
         if (s->escape > 0){
             s->escape = 0;
         }
@@ -42,126 +88,923 @@ void parsejsonl(string &str, JSONLgenState *s){
             s->escape = 1;
         }
         else if(c == '"'){
+            s->quote = 1 - s->quote;
             if(s->list < 2){
                 if(s->item < 0){
-                    s->item = s->pos;
-                } else if (s->obj == 0){
-                    if(DEBUG) cerr << "yielding 1" << endl;
-                    s->items.push(string(s->data.begin() + s->item, s->data.begin() + s->pos + 1));
-                    s->data.erase(s->data.begin(), s->data.begin() + s->pos + 1);
-                    s->pos = -1;
+                    s->item = p;
+                } else if (s->obj == 0 && !s->quote){
+                    *start = s->item;
+                    *end = p + 1;
                     s->item = -1;
+                    return true;
                 }
             }
-            s->quote = 1 - s->quote;
         }
         else if (s->quote > 0) ;
         else if (c == '}'){
             s->obj--;
-            if (s->obj == 0 && (! (s->item < 0) && s->data[s->item] == '{')){
-                if(DEBUG) cerr << "yielding 2" << endl;
-                s->items.push(string(s->data.begin() + s->item, s->data.begin() + s->pos + 1));
-                s->data.erase(s->data.begin(), s->data.begin() + s->pos + 1);
-                s->pos = -1;
+            if (s->obj == 0 && (! (s->item < 0) && buf[s->item] == '{')){
+                *start = s->item;
+                *end = p + 1;
                 s->item = -1;
+                return true;
             }
         }
         else if (c == '{'){
             s->obj++;
-            if(s->item < 0) { s->item = s->pos; }
+            if(s->item < 0) { s->item = p; }
         }
         else if (c == '['){
             s->list++;
-            if(s->list > 1 && s->item < 0) { s->item = s->pos; }
+            if(s->list > 1 && s->item < 0) { s->item = p; }
         }
         else if (c == ']') {
             s->list--;
-            if (s->list == 1 && (! (s->item < 0) && s->data[s->item] == '[')){
-                if(DEBUG) cerr << "yielding 3" << endl;
-                s->items.push(string(s->data.begin() + s->item, s->data.begin() + s->pos + 1));
-                s->data.erase(s->data.begin(), s->data.begin() + s->pos + 1);
-                s->pos = -1;
+            if (s->list == 1 && (! (s->item < 0) && buf[s->item] == '[')){
+                *start = s->item;
+                *end = p + 1;
                 s->item = -1;
+                return true;
+            }
+        }
+    }
+    return false;
+}
+
+
+/* Decoding records straight to Python objects
+ *
+ * The decoders below return a new reference, or NULL. A NULL without an
+ * exception set means that the record is malformed, so that malformed
+ * records can be skipped without raising and catching an exception for
+ * each of them.
+ */
+static PyObject *decode_value(JSONLgenState *s, const char *&p, const char *end, int depth,
+                              PyObject *fields = NULL);
+
+static inline void
+skip_ws(const char *&p, const char *end)
+{
+    while (p < end && (*p == ' ' || *p == '\n' || *p == '\r' || *p == '\t'))
+        p++;
+}
+
+static inline int
+hexval(char c)
+{
+    if (c >= '0' && c <= '9') return c - '0';
+    if (c >= 'a' && c <= 'f') return c - 'a' + 10;
+    if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+    return -1;
+}
+
+static bool
+read_hex4(const char *p, const char *end, unsigned int *cp)
+{
+    if (end - p < 4)
+        return false;
+    *cp = 0;
+    for (int i = 0; i < 4; i++) {
+        int v = hexval(p[i]);
+        if (v < 0)
+            return false;
+        *cp = (*cp << 4) | v;
+    }
+    return true;
+}
+
+static void
+append_utf8(string &out, unsigned int cp)
+{
+    if (cp < 0x80) {
+        out += (char)cp;
+    } else if (cp < 0x800) {
+        out += (char)(0xC0 | (cp >> 6));
+        out += (char)(0x80 | (cp & 0x3F));
+    } else if (cp < 0x10000) {
+        out += (char)(0xE0 | (cp >> 12));
+        out += (char)(0x80 | ((cp >> 6) & 0x3F));
+        out += (char)(0x80 | (cp & 0x3F));
+    } else {
+        out += (char)(0xF0 | (cp >> 18));
+        out += (char)(0x80 | ((cp >> 12) & 0x3F));
+        out += (char)(0x80 | ((cp >> 6) & 0x3F));
+        out += (char)(0x80 | (cp & 0x3F));
+    }
+}
+
+/* Unescape the body of a string literal into utf-8 */
+static bool
+unescape(const char *p, const char *end, string &out)
+{
+    out.reserve(end - p);
+    while (p < end) {
+        if (*p != '\\') {
+            out += *p++;
+            continue;
+        }
+        if (++p >= end)
+            return false;
+        switch (*p++) {
+            case '"': out += '"'; break;
+            case '\\': out += '\\'; break;
+            case '/': out += '/'; break;
+            case 'b': out += '\b'; break;
+            case 'f': out += '\f'; break;
+            case 'n': out += '\n'; break;
+            case 'r': out += '\r'; break;
+            case 't': out += '\t'; break;
+            case 'u': {
+                unsigned int cp, lo;
+                if (!read_hex4(p, end, &cp))
+                    return false;
+                p += 4;
+                if (cp >= 0xD800 && cp < 0xDC00 && end - p >= 6 && p[0] == '\\' && p[1] == 'u'
+                        && read_hex4(p + 2, end, &lo) && lo >= 0xDC00 && lo < 0xE000) {
+                    cp = 0x10000 + ((cp - 0xD800) << 10) + (lo - 0xDC00);
+                    p += 6;
+                }
+                append_utf8(out, cp);
+                break;
             }
+            default:
+                return false;
         }
     }
+    return true;
 }
 
+/* Find the end of a string literal starting after the opening quote */
+static const char *
+string_end(const char *p, const char *end, bool *escaped)
+{
+    *escaped = false;
+    while (p < end) {
+        const unsigned char c = *p;
+        if (c == '"')
+            return p;
+        if (c == '\\') {
+            *escaped = true;
+            p += 2;
+            continue;
+        }
+        if (c < 0x20)
+            return NULL;
+        p++;
+    }
+    return NULL;
+}
 
 static PyObject *
-jsonlgen_next(JSONLgenState *jfstate)
+decode_string(const char *&p, const char *end)
 {
-    /* seq_length < 0 means that the generator is exhausted.
-     * Returning NULL in this case is enough. The next() builtin will raise the
-     * StopIteration error for us->
-    */
-    if ( !jfstate->items.empty() ) {
-        string item = jfstate->items.front();
-        if(DEBUG) cerr << "Items has " << jfstate->items.size() << " items. Yielding " << item << endl;
-        PyObject *result = Py_BuildValue("s", item.c_str());
-        jfstate->items.pop();
-        return result;
+    bool escaped;
+    const char *close = string_end(++p, end, &escaped);
+    if (!close)
+        return NULL;
+    const char *start = p;
+    p = close + 1;
+    if (!escaped)
+        return PyUnicode_DecodeUTF8(start, close - start, NULL);
+    string out;
+    if (!unescape(start, close, out))
+        return NULL;
+    /* lone surrogates are valid in json strings */
+    return PyUnicode_DecodeUTF8(out.data(), out.size(), "surrogatepass");
+}
+
+/* Decode an object key. Keys without escapes are interned and shared
+ * between records, since the same keys repeat in nearly every record.
+ * Without a state (s is NULL) keys are not interned.
+ */
+static PyObject *
+decode_key(JSONLgenState *s, const char *&p, const char *end)
+{
+    if (p >= end || *p != '"')
+        return NULL;
+    bool escaped;
+    const char *close = string_end(p + 1, end, &escaped);
+    if (!close)
+        return NULL;
+    if (escaped || !s)
+        return decode_string(p, end);
+    string raw(p + 1, close);
+    p = close + 1;
+    auto it = s->keys.find(raw);
+    if (it != s->keys.end()) {
+        Py_INCREF(it->second);
+        return it->second;
     }
-    PyObject *iterator = PyObject_GetIter(jfstate->iter);
+    PyObject *key = PyUnicode_DecodeUTF8(raw.data(), raw.size(), NULL);
+    if (!key)
+        return NULL;
+    PyUnicode_InternInPlace(&key);
+    if (s->keys.size() < MAX_INTERNED_KEYS) {
+        Py_INCREF(key);
+        s->keys.emplace(std::move(raw), key);
+    }
+    return key;
+}
 
-    PyObject *elem;
-    while((elem = PyIter_Next(iterator))) {
-        /* Exceptions from PySequence_GetItem are propagated to the caller
-         * (elem will be NULL so we also return NULL).
-        */
-        if (elem) {
-            string str(PyUnicode_AsUTF8(elem));
-            parsejsonl(str, jfstate);
-            if ( !jfstate->items.empty() ) {
-                string item = jfstate->items.front();
-                if(DEBUG) cerr << "Items has " << jfstate->items.size() << " items. Yielding " << item << endl;
-                PyObject *result = Py_BuildValue("s", item.c_str());
-                jfstate->items.pop();
-                return result;
+static bool
+scan_number(const char *&p, const char *end, bool *is_float)
+{
+    *is_float = false;
+    if (p < end && *p == '-')
+        p++;
+    if (p < end && *p == '0') {
+        p++;
+    } else if (p < end && *p >= '1' && *p <= '9') {
+        while (p < end && *p >= '0' && *p <= '9') p++;
+    } else {
+        return false;
+    }
+    if (p < end && *p == '.') {
+        *is_float = true;
+        const char *digits = ++p;
+        while (p < end && *p >= '0' && *p <= '9') p++;
+        if (p == digits)
+            return false;
+    }
+    if (p < end && (*p == 'e' || *p == 'E')) {
+        *is_float = true;
+        p++;
+        if (p < end && (*p == '+' || *p == '-'))
+            p++;
+        const char *digits = p;
+        while (p < end && *p >= '0' && *p <= '9') p++;
+        if (p == digits)
+            return false;
+    }
+    return true;
+}
+
+static PyObject *
+decode_number(const char *&p, const char *end)
+{
+    const char *start = p;
+    bool is_float;
+    if (!scan_number(p, end, &is_float))
+        return NULL;
+    if (!is_float && p - start <= 18) {
+        long long val = 0;
+        const char *q = start + (*start == '-');
+        for (; q < p; q++)
+            val = val * 10 + (*q - '0');
+        return PyLong_FromLongLong(*start == '-' ? -val : val);
+    }
+    string num(start, p);
+    if (!is_float)
+        return PyLong_FromString(num.c_str(), NULL, 10);
+    double d = PyOS_string_to_double(num.c_str(), NULL, NULL);
+    if (d == -1.0 && PyErr_Occurred())
+        return NULL;
+    return PyFloat_FromDouble(d);
+}
+
+static bool
+match(const char *&p, const char *end, const char *lit, size_t len)
+{
+    if ((size_t)(end - p) < len || memcmp(p, lit, len))
+        return false;
+    p += len;
+    return true;
+}
+
+static bool
+skip_string(const char *&p, const char *end)
+{
+    unsigned int cp;
+    for (p++; p < end; p++) {
+        const unsigned char c = *p;
+        if (c == '"') {
+            p++;
+            return true;
+        }
+        if (c < 0x20)
+            return false;
+        if (c == '\\') {
+            if (++p >= end)
+                return false;
+            if (*p == 'u') {
+                if (!read_hex4(p + 1, end, &cp))
+                    return false;
+                p += 4;
+            } else if (!*p || !strchr("\"\\/bfnrt", *p)) {
+                return false;
             }
         }
-        Py_DECREF(elem);
     }
+    return false;
+}
+
+/* Skip a value without decoding it. The value is checked as strictly as by
+ * the decoder, except for the utf-8 encoding of strings.
+ */
+static bool
+skip_value(const char *&p, const char *end, int depth)
+{
+    if (p >= end || depth > MAX_DEPTH)
+        return false;
+    bool is_float;
+    switch (*p) {
+        case '{':
+        case '[': {
+            const bool is_obj = *p == '{';
+            const char close = is_obj ? '}' : ']';
+            p++;
+            skip_ws(p, end);
+            if (p < end && *p == close) {
+                p++;
+                return true;
+            }
+            while (p < end) {
+                if (is_obj) {
+                    if (*p != '"' || !skip_string(p, end))
+                        return false;
+                    skip_ws(p, end);
+                    if (p >= end || *p != ':')
+                        return false;
+                    p++;
+                    skip_ws(p, end);
+                }
+                if (!skip_value(p, end, depth + 1))
+                    return false;
+                skip_ws(p, end);
+                if (p < end && *p == ',') {
+                    p++;
+                    skip_ws(p, end);
+                } else if (p < end && *p == close) {
+                    p++;
+                    return true;
+                } else {
+                    return false;
+                }
+            }
+            return false;
+        }
+        case '"': return skip_string(p, end);
+        case 't': return match(p, end, "true", 4);
+        case 'f': return match(p, end, "false", 5);
+        case 'n': return match(p, end, "null", 4);
+        case 'N': return match(p, end, "NaN", 3);
+        case 'I': return match(p, end, "Infinity", 8);
+        case '-':
+            if (match(p, end, "-Infinity", 9))
+                return true;
+            return scan_number(p, end, &is_float);
+        default: return scan_number(p, end, &is_float);
+    }
+}
+
+/* Decode an object. If fields is a dict, only its keys are decoded and the
+ * rest are skipped. The values of fields are either None for the whole value
+ * or a dict of the fields to decode from it.
+ */
+static PyObject *
+decode_object(JSONLgenState *s, const char *&p, const char *end, int depth, PyObject *fields)
+{
+    PyObject *dict = PyDict_New();
+    if (!dict)
+        return NULL;
+    p++;
+    skip_ws(p, end);
+    if (p < end && *p == '}') {
+        p++;
+        return dict;
+    }
+    while (p < end) {
+        PyObject *key = decode_key(s, p, end);
+        if (!key)
+            break;
+        skip_ws(p, end);
+        if (p >= end || *p != ':') {
+            Py_DECREF(key);
+            break;
+        }
+        p++;
+        skip_ws(p, end);
+        PyObject *sub = NULL;
+        if (fields && !(sub = PyDict_GetItemWithError(fields, key))) {
+            Py_DECREF(key);
+            if (PyErr_Occurred() || !skip_value(p, end, depth))
+                break;
+        } else {
+            PyObject *val = decode_value(s, p, end, depth, sub == Py_None ? NULL : sub);
+            if (!val) {
+                Py_DECREF(key);
+                break;
+            }
+            int err = PyDict_SetItem(dict, key, val);
+            Py_DECREF(key);
+            Py_DECREF(val);
+            if (err < 0)
+                break;
+        }
+        skip_ws(p, end);
+        if (p < end && *p == ',') {
+            p++;
+            skip_ws(p, end);
+        } else if (p < end && *p == '}') {
+            p++;
+            return dict;
+        } else {
+            break;
+        }
+    }
+    Py_DECREF(dict);
+    return NULL;
+}
+
+static PyObject *
+decode_array(JSONLgenState *s, const char *&p, const char *end, int depth)
+{
+    PyObject *list = PyList_New(0);
+    if (!list)
+        return NULL;
+    p++;
+    skip_ws(p, end);
+    if (p < end && *p == ']') {
+        p++;
+        return list;
+    }
+    while (p < end) {
+        PyObject *val = decode_value(s, p, end, depth);
+        if (!val)
+            break;
+        int err = PyList_Append(list, val);
+        Py_DECREF(val);
+        if (err < 0)
+            break;
+        skip_ws(p, end);
+        if (p < end && *p == ',') {
+            p++;
+            skip_ws(p, end);
+        } else if (p < end && *p == ']') {
+            p++;
+            return list;
+        } else {
+            break;
+        }
+    }
+    Py_DECREF(list);
+    return NULL;
+}
+
+static PyObject *
+decode_value(JSONLgenState *s, const char *&p, const char *end, int depth, PyObject *fields)
+{
+    if (p >= end || depth > MAX_DEPTH)
+        return NULL;
+    switch (*p) {
+        case '{': return decode_object(s, p, end, depth + 1, fields);
+        case '[': return decode_array(s, p, end, depth + 1);
+        case '"': return decode_string(p, end);
+        case 't': if (match(p, end, "true", 4)) Py_RETURN_TRUE; return NULL;
+        case 'f': if (match(p, end, "false", 5)) Py_RETURN_FALSE; return NULL;
+        case 'n': if (match(p, end, "null", 4)) Py_RETURN_NONE; return NULL;
+        case 'N': if (match(p, end, "NaN", 3)) return PyFloat_FromDouble(Py_NAN); return NULL;
+        case 'I': if (match(p, end, "Infinity", 8)) return PyFloat_FromDouble(Py_HUGE_VAL); return NULL;
+        case '-':
+            if (match(p, end, "-Infinity", 9))
+                return PyFloat_FromDouble(-Py_HUGE_VAL);
+            return decode_number(p, end);
+        default: return decode_number(p, end);
+    }
+}
+
+/* Check the raw bytes of an item against the prefilter.
+ *
+ * The prefilter is a list of alternatives, each a list of byte strings that
+ * must all be found in the item. Items with escapes that may spell the
+ * strings differently always pass: \/ and \u escapes of ascii characters,
+ * and with non-ascii strings any \u escapes.
+ */
+static bool
+prefilter_match(JSONLgenState *s, const char *buf, Py_ssize_t len)
+{
+    for (const auto &needles : s->prefilter) {
+        bool found = true;
+        for (const auto &needle : needles) {
+            if (!memmem(buf, len, needle.data(), needle.size())) {
+                found = false;
+                break;
+            }
+        }
+        if (found)
+            return true;
+    }
+    const char *p = buf, *end = buf + len;
+    unsigned int cp;
+    while ((p = (const char *)memchr(p, '\\', end - p)) && p + 1 < end) {
+        if (p[1] == '/')
+            return true;
+        if (p[1] == 'u' && (!s->prefilter_ascii || !read_hex4(p + 2, end, &cp) || cp < 0x80))
+            return true;
+        p += 2;
+    }
+    return false;
+}
+
+
+/* Index the fields of an object record and pass the raw record and the index
+ * to s->lazy. The index is a dict from the keys to the (start, end) offsets
+ * of the values in the record, so that the values can be decoded later.
+ */
+static PyObject *
+lazy_record(JSONLgenState *s, const char *&p, const char *end)
+{
+    const char *start = p;
+    PyObject *index = PyDict_New();
+    if (!index)
+        return NULL;
+    p++;
+    skip_ws(p, end);
+    bool ok = p < end && *p == '}';
+    while (!ok && p < end) {
+        PyObject *key = decode_key(s, p, end);
+        if (!key)
+            break;
+        skip_ws(p, end);
+        if (p >= end || *p != ':') {
+            Py_DECREF(key);
+            break;
+        }
+        p++;
+        skip_ws(p, end);
+        const char *value = p;
+        if (!skip_value(p, end, 1)) {
+            Py_DECREF(key);
+            break;
+        }
+        PyObject *span = Py_BuildValue("nn", (Py_ssize_t)(value - start),
+                                       (Py_ssize_t)(p - start));
+        int err = span ? PyDict_SetItem(index, key, span) : -1;
+        Py_XDECREF(span);
+        Py_DECREF(key);
+        if (err < 0)
+            break;
+        skip_ws(p, end);
+        if (p < end && *p == ',') {
+            p++;
+            skip_ws(p, end);
+        } else {
+            ok = p < end && *p == '}';
+            break;
+        }
+    }
+    PyObject *ret = NULL;
+    if (ok) {
+        p++;
+        PyObject *raw = PyBytes_FromStringAndSize(start, p - start);
+        if (raw) {
+            ret = PyObject_CallFunctionObjArgs(s->lazy, raw, index, NULL);
+            Py_DECREF(raw);
+        }
+    }
+    Py_DECREF(index);
+    return ret;
+}
+
+
+/* Turn the item buf[0:len] into the object returned by the generator.
+ *
+ * Returns 1 and sets *out on success, 0 for a skipped malformed or
+ * prefiltered record and -1 with an exception set on errors.
+ */
+static int
+emit_item(JSONLgenState *s, const char *buf, Py_ssize_t len, PyObject **out)
+{
+    if (!s->prefilter.empty() && !prefilter_match(s, buf, len))
+        return 0;
+    if (!s->decode) {
+        *out = PyUnicode_DecodeUTF8(buf, len, NULL);
+        return *out ? 1 : -1;
+    }
+    const char *p = buf, *end = buf + len;
+    PyObject *ret;
+    if (s->lazy && *p == '{')
+        ret = lazy_record(s, p, end);
+    else
+        ret = decode_value(s, p, end, 0, s->fields);
+    if (ret) {
+        skip_ws(p, end);
+        if (p == end) {
+            *out = ret;
+            return 1;
+        }
+        Py_CLEAR(ret);
+    }
+    if (PyErr_Occurred()) {
+        /* Invalid utf-8 or out of range numbers are malformed records too */
+        if (!PyErr_ExceptionMatches(PyExc_ValueError))
+            return -1;
+        PyErr_Clear();
+    }
+    s->errors++;
+    if (s->strict) {
+        PyErr_Format(PyExc_ValueError, "Malformed json record at offset %zd: %.200s",
+                     (Py_ssize_t)(p - buf), string(buf, len).c_str());
+        return -1;
+    }
+    return 0;
+}
+
+
+/* Append a chunk to the internal buffer.
+ *
+ * The buffer is only compacted when the consumed prefix is at least half of
+ * it, so every byte is moved at most a constant number of times and item
+ * extraction stays amortised O(1) even for a huge single json document.
+ */
+static void
+feed_chunk(JSONLgenState *s, const char *str, Py_ssize_t len)
+{
+    Py_ssize_t keep = s->item >= 0 ? s->item : s->data_pos;
+    if (keep > s->head)
+        s->head = keep;
+    if (s->head > 0 && s->head >= (Py_ssize_t)s->data.size() / 2) {
+        s->data.erase(s->data.begin(), s->data.begin() + s->head);
+        s->data_pos -= s->head;
+        if (s->item >= 0)
+            s->item -= s->head;
+        s->head = 0;
+    }
+    s->data.insert(s->data.end(), str, str + len);
+}
+
+
+/* Feed one element of the input iterable to the scanner.
+ *
+ * Elements may be str or any object supporting the buffer protocol
+ * (bytes, bytearray, memoryview, mmap, ...). Buffers are scanned as raw
+ * UTF-8 without decoding them to str first.
+ */
+static int
+feed_elem(JSONLgenState *jfstate, PyObject *elem)
+{
+    if (PyUnicode_Check(elem)) {
+        Py_ssize_t len;
+        const char *str = PyUnicode_AsUTF8AndSize(elem, &len);
+        if (!str)
+            return -1;
+        feed_chunk(jfstate, str, len);
+        return 0;
+    }
+    Py_buffer view;
+    if (PyObject_GetBuffer(elem, &view, PyBUF_SIMPLE) < 0)
+        return -1;
+    feed_chunk(jfstate, (const char *)view.buf, view.len);
+    PyBuffer_Release(&view);
+    return 0;
+}
+
+
+/* Emit buffered items until one is returned. Returns 0 when the buffer
+ * holds no more complete items.
+ */
+static int
+pop_item(JSONLgenState *jfstate, PyObject **out)
+{
+    Py_ssize_t start, end;
+    while (scan_next(jfstate, jfstate->data.data(), jfstate->data.size(),
+                     &jfstate->data_pos, &start, &end)) {
+        const char *buf = jfstate->data.data();
+        if(DEBUG) cerr << "Yielding " << string(buf + start, buf + end) << endl;
+        jfstate->head = end;
+        int ret = emit_item(jfstate, buf + start, end - start, out);
+        if (ret != 0)
+            return ret;
+    }
+    return 0;
+}
+
 
-    /* The reference to the sequence is cleared in the first generator call
-     * after its exhaustion (after the call that returned the last element).
-     * Py_CLEAR will be harmless for subsequent calls since it's idempotent
-     * on NULL.
+static PyObject *
+next_item(JSONLgenState *jfstate)
+{
+    /* Returning NULL without an exception set is enough when the input is
+     * exhausted. The next() builtin will raise the StopIteration for us.
     */
-    Py_DECREF(iterator);
+    PyObject *result;
+    if (jfstate->has_view) {
+        /* A single buffer is scanned in place: items are decoded straight
+         * from the caller's memory without an intermediate copy.
+        */
+        Py_ssize_t start, end;
+        const char *buf = (const char *)jfstate->view.buf;
+        while (scan_next(jfstate, buf, jfstate->view.len, &jfstate->view_pos, &start, &end)) {
+            int ret = emit_item(jfstate, buf + start, end - start, &result);
+            if (ret != 0)
+                return ret > 0 ? result : NULL;
+        }
+        jsonlgen_release(jfstate);
+        return NULL;
+    }
+    int ret = pop_item(jfstate, &result);
+    if (ret != 0)
+        return ret > 0 ? result : NULL;
+    if (!jfstate->iter)
+        return NULL;
+
+    PyObject *elem;
+    while((elem = PyIter_Next(jfstate->iter))) {
+        int err = feed_elem(jfstate, elem);
+        Py_DECREF(elem);
+        if (err < 0)
+            return NULL;
+        ret = pop_item(jfstate, &result);
+        if (ret != 0)
+            return ret > 0 ? result : NULL;
+    }
+    /* Drop the reference to the input as soon as it is exhausted. PyIter_Next
+     * returns NULL both on exhaustion and on error; the error is propagated.
+    */
+    Py_CLEAR(jfstate->iter);
     return NULL;
 }
 
+/* Collect up to n items into a list, so that the python side pays the
+ * per-call overhead once per batch instead of once per record.
+ */
 static PyObject *
-jsonlgen_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+next_batch(JSONLgenState *jfstate, Py_ssize_t n)
 {
-    PyObject *iter;
+    PyObject *list = PyList_New(0);
+    if (!list)
+        return NULL;
+    while (PyList_GET_SIZE(list) < n) {
+        PyObject *item = next_item(jfstate);
+        if (!item) {
+            if (PyErr_Occurred()) {
+                Py_DECREF(list);
+                return NULL;
+            }
+            break;
+        }
+        int err = PyList_Append(list, item);
+        Py_DECREF(item);
+        if (err < 0) {
+            Py_DECREF(list);
+            return NULL;
+        }
+    }
+    return list;
+}
 
-    if (!PyArg_UnpackTuple(args, "gen", 1, 1, &iter))
+static PyObject *
+jsonlgen_next(JSONLgenState *jfstate)
+{
+    if (jfstate->batch <= 0)
+        return next_item(jfstate);
+    PyObject *list = next_batch(jfstate, jfstate->batch);
+    if (list && PyList_GET_SIZE(list) == 0)
+        Py_CLEAR(list);
+    return list;
+}
+
+static PyObject *
+jsonlgen_next_batch(JSONLgenState *jfstate, PyObject *args)
+{
+    Py_ssize_t n = jfstate->batch > 0 ? jfstate->batch : DEFAULT_BATCH;
+    if (!PyArg_ParseTuple(args, "|n:next_batch", &n))
         return NULL;
+    return next_batch(jfstate, n);
+}
 
-    /* We expect an argument that supports the sequence protocol */
-    if (!PyIter_Check(iter)) {
-        PyErr_SetString(PyExc_TypeError, "jsonlgen.gen() expects a iterable");
+static PyMethodDef jsonlgen_methods[] = {
+    {"next_batch", (PyCFunction)jsonlgen_next_batch, METH_VARARGS,
+     "next_batch([n]) -> list\n\n"
+     "Return a list of up to n (default: batch) next records. The list is empty when the\n"
+     "input is exhausted."},
+    {NULL}
+};
+
+/* Convert a sequence of sequences of bytes or str to the prefilter */
+static int
+parse_prefilter(JSONLgenState *s, PyObject *obj)
+{
+    vector<vector<string> > &out = s->prefilter;
+    PyObject *alts = PySequence_Fast(obj, "prefilter must be a sequence");
+    if (!alts)
+        return -1;
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(alts); i++) {
+        PyObject *needles = PySequence_Fast(PySequence_Fast_GET_ITEM(alts, i),
+                                            "prefilter items must be sequences");
+        if (!needles) {
+            Py_DECREF(alts);
+            return -1;
+        }
+        out.emplace_back();
+        for (Py_ssize_t j = 0; j < PySequence_Fast_GET_SIZE(needles); j++) {
+            PyObject *needle = PySequence_Fast_GET_ITEM(needles, j);
+            const char *str;
+            Py_ssize_t len;
+            if (PyUnicode_Check(needle)) {
+                str = PyUnicode_AsUTF8AndSize(needle, &len);
+            } else if (PyBytes_AsStringAndSize(needle, (char **)&str, &len) < 0) {
+                str = NULL;
+            }
+            if (!str) {
+                Py_DECREF(needles);
+                Py_DECREF(alts);
+                return -1;
+            }
+            out.back().emplace_back(str, len);
+            for (Py_ssize_t k = 0; k < len; k++)
+                if ((unsigned char)str[k] >= 0x80)
+                    s->prefilter_ascii = 0;
+        }
+        Py_DECREF(needles);
+    }
+    Py_DECREF(alts);
+    return 0;
+}
+
+static PyObject *
+jsonlgen_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static const char *kwlist[] = {"input", "decode", "strict", "batch", "prefilter",
+                                   "fields", "lazy", NULL};
+    PyObject *inp, *prefilter = Py_None, *fields = Py_None, *lazy = Py_None;
+    int decode = 0, strict = 0;
+    Py_ssize_t batch = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|ppnOOO:gen", (char **)kwlist,
+                                     &inp, &decode, &strict, &batch, &prefilter,
+                                     &fields, &lazy))
+        return NULL;
+    if (fields != Py_None && !PyDict_Check(fields)) {
+        PyErr_SetString(PyExc_TypeError, "fields must be a dict");
+        return NULL;
+    }
+    if (lazy != Py_None && !PyCallable_Check(lazy)) {
+        PyErr_SetString(PyExc_TypeError, "lazy must be callable");
         return NULL;
     }
 
-    /* Create a new JSONLgenState and initialize its state - pointing to the last
-     * index in the sequence.
+    /* Create a new JSONLgenState and construct the C++ members in place, as
+     * tp_alloc only zeroes the memory.
     */
     JSONLgenState *jfstate = (JSONLgenState *)type->tp_alloc(type, 0);
     if (!jfstate)
         return NULL;
-
-    Py_INCREF(iter);
-    jfstate->iter = iter;
+    new (&jfstate->data) vector<char>();
+    new (&jfstate->keys) unordered_map<string, PyObject *>();
+    new (&jfstate->prefilter) vector<vector<string> >();
+    jfstate->decode = decode;
+    jfstate->strict = strict;
+    jfstate->batch = batch;
+    jfstate->errors = 0;
+    jfstate->iter = NULL;
+    jfstate->has_view = 0;
+    jfstate->view_pos = 0;
+    jfstate->head = 0;
+    jfstate->data_pos = 0;
     jfstate->item = -1 ;
-    jfstate->pos = -1 ;
-    jfstate->items = queue<string>();
+    jfstate->prefilter_ascii = 1;
+    jfstate->fields = fields != Py_None ? fields : NULL;
+    jfstate->lazy = lazy != Py_None ? lazy : NULL;
+    Py_XINCREF(jfstate->fields);
+    Py_XINCREF(jfstate->lazy);
+
+    if (prefilter != Py_None && parse_prefilter(jfstate, prefilter) < 0) {
+        Py_DECREF(jfstate);
+        return NULL;
+    }
+
+    /* We expect either a buffer or an iterable of str/buffer chunks */
+    if (!PyUnicode_Check(inp) && PyObject_CheckBuffer(inp)) {
+        if (PyObject_GetBuffer(inp, &jfstate->view, PyBUF_SIMPLE) < 0) {
+            Py_DECREF(jfstate);
+            return NULL;
+        }
+        jfstate->has_view = 1;
+    } else {
+        jfstate->iter = PyObject_GetIter(inp);
+        if (!jfstate->iter) {
+            Py_DECREF(jfstate);
+            PyErr_SetString(PyExc_TypeError,
+                            "jsonlgen.gen() expects a buffer or an iterable");
+            return NULL;
+        }
+    }
 
     return (PyObject *)jfstate;
 }
 
+static PyObject *
+jsonlgen_get_errors(JSONLgenState *jfstate, void *closure)
+{
+    return PyLong_FromSsize_t(jfstate->errors);
+}
+
+static PyGetSetDef jsonlgen_getset[] = {
+    {"errors", (getter)jsonlgen_get_errors, NULL,
+     "Number of malformed records skipped when decoding", NULL},
+    {NULL}
+};
+
 PyTypeObject PyJSONLgen_Type = {
     PyVarObject_HEAD_INIT(&PyType_Type, 0)
     "gen",                       /* tp_name */
@@ -183,16 +1026,31 @@ PyTypeObject PyJSONLgen_Type = {
     0,                              /* tp_setattro */
     0,                              /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,             /* tp_flags */
-    0,                              /* tp_doc */
+    "gen(input, decode=False, strict=False, batch=0, prefilter=None, fields=None,\n"
+    "    lazy=None)\n--\n\n"
+    "Split json and json lines into json strings of the records.\n\n"
+    "input is either a single buffer (bytes, bytearray, memoryview, mmap, ...)\n"
+    "which is scanned in place, or an iterable of str or buffer chunks.\n\n"
+    "With decode the records are decoded while scanning and returned as python\n"
+    "objects. Malformed records are then skipped and counted in errors, or\n"
+    "raise ValueError if strict is set.\n\n"
+    "With batch > 0 iteration yields lists of up to batch records.\n\n"
+    "prefilter is a list of alternatives, each a list of byte strings. Records\n"
+    "not containing all the strings of any alternative are skipped before\n"
+    "decoding, unless they have escapes which may spell the strings differently.\n\n"
+    "When decoding, fields limits the decoded fields of object records to a tree\n"
+    "of dicts: {key: None for the whole value or a dict of its fields to decode}.\n"
+    "With lazy, object records are instead passed to lazy(raw, index), where\n"
+    "index has the (start, end) offsets of the values in raw by key.", /* tp_doc */
     0,                              /* tp_traverse */
     0,                              /* tp_clear */
     0,                              /* tp_richcompare */
     0,                              /* tp_weaklistoffset */
     PyObject_SelfIter,              /* tp_iter */
     (iternextfunc)jsonlgen_next,      /* tp_iternext */
-    0,                              /* tp_methods */
+    jsonlgen_methods,               /* tp_methods */
     0,                              /* tp_members */
-    0,                              /* tp_getset */
+    jsonlgen_getset,                /* tp_getset */
     0,                              /* tp_base */
     0,                              /* tp_dict */
     0,                              /* tp_descr_get */
@@ -204,12 +1062,203 @@ PyTypeObject PyJSONLgen_Type = {
 };
 
 
+static inline bool
+is_dunder(PyObject *name)
+{
+    return PyUnicode_GET_LENGTH(name) > 1 && PyUnicode_READ_CHAR(name, 0) == '_'
+           && PyUnicode_READ_CHAR(name, 1) == '_';
+}
+
+static PyObject *
+record_none(PyObject *self)
+{
+    static PyObject *none_name = NULL;
+    if (!none_name && !(none_name = PyUnicode_InternFromString("_none")))
+        return NULL;
+    PyObject *none = PyObject_GetAttr((PyObject *)Py_TYPE(self), none_name);
+    if (!none)
+        return NULL;
+    PyObject *ret = PyObject_CallFunctionObjArgs(none, NULL);
+    Py_DECREF(none);
+    return ret;
+}
+
+/* Whether a class in the mro of type has the attribute name, -1 on errors */
+static int
+class_has_attr(PyTypeObject *type, PyObject *name)
+{
+    PyObject *mro = type->tp_mro;
+    for (Py_ssize_t i = 0; i < PyTuple_GET_SIZE(mro); i++) {
+#if PY_VERSION_HEX >= 0x030C0000
+        PyObject *dict = PyType_GetDict((PyTypeObject *)PyTuple_GET_ITEM(mro, i));
+#else
+        PyObject *dict = ((PyTypeObject *)PyTuple_GET_ITEM(mro, i))->tp_dict;
+        Py_XINCREF(dict);
+#endif
+        if (!dict)
+            return 1;
+        PyObject *attr = PyDict_GetItemWithError(dict, name);
+        Py_DECREF(dict);
+        if (attr)
+            return 1;
+        if (PyErr_Occurred())
+            return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+record_getattro(PyObject *self, PyObject *name)
+{
+    if (!PyUnicode_Check(name) || is_dunder(name))
+        return PyObject_GenericGetAttr(self, name);
+    PyObject *value = PyDict_GetItemWithError(self, name);
+    if (!value) {
+        if (PyErr_Occurred())
+            return NULL;
+        /* Records have no instance attributes, only fields and those of the class */
+        int has_attr = class_has_attr(Py_TYPE(self), name);
+        if (has_attr < 0)
+            return NULL;
+        if (!has_attr)
+            return record_none(self);
+        value = PyObject_GenericGetAttr(self, name);
+        if (value || !PyErr_ExceptionMatches(PyExc_AttributeError))
+            return value;
+        PyErr_Clear();
+        return record_none(self);
+    }
+    if (value == Py_None)
+        return record_none(self);
+    if (PyDict_Check(value) && Py_TYPE(value) != Py_TYPE(self)) {
+        value = PyObject_CallFunctionObjArgs((PyObject *)Py_TYPE(self), value, NULL);
+        if (value && PyDict_SetItem(self, name, value) < 0)
+            Py_CLEAR(value);
+        return value;
+    }
+    Py_INCREF(value);
+    return value;
+}
+
+PyTypeObject PyRecord_Type = {
+    PyVarObject_HEAD_INIT(&PyType_Type, 0)
+    "record",                       /* tp_name */
+    sizeof(PyDictObject),           /* tp_basicsize */
+    0,                              /* tp_itemsize */
+    0,                              /* tp_dealloc */
+    0,                              /* tp_print */
+    0,                              /* tp_getattr */
+    0,                              /* tp_setattr */
+    0,                              /* tp_reserved */
+    0,                              /* tp_repr */
+    0,                              /* tp_as_number */
+    0,                              /* tp_as_sequence */
+    0,                              /* tp_as_mapping */
+    0,                              /* tp_hash */
+    0,                              /* tp_call */
+    0,                              /* tp_str */
+    record_getattro,                /* tp_getattro */
+    0,                              /* tp_setattro */
+    0,                              /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /* tp_flags */
+    "Dict whose fields are read as attributes.\n\n"
+    "Fields shadow the attributes of the same name. Missing and null fields are\n"
+    "read as _none() of the class, and dict fields are wrapped in the class when\n"
+    "they are first read and kept in their place.", /* tp_doc */
+};
+
+static PyObject *
+plain_value(PyObject *value, int depth)
+{
+    if (depth > MAX_DEPTH) {
+        PyErr_SetString(PyExc_RecursionError, "Too deeply nested item");
+        return NULL;
+    }
+    PyObject *copy = NULL, *key, *item;
+    if (PyDict_Check(value)) {
+        if (PyObject_TypeCheck(value, &PyRecord_Type) && !(copy = PyDict_New()))
+            return NULL;
+        Py_ssize_t pos = 0;
+        while (PyDict_Next(value, &pos, &key, &item)) {
+            PyObject *ret = plain_value(item, depth + 1);
+            if (ret && ret != item && !copy && !(copy = PyDict_Copy(value)))
+                Py_CLEAR(ret);
+            if (!ret || (copy && PyDict_SetItem(copy, key, ret) < 0)) {
+                Py_XDECREF(ret);
+                Py_XDECREF(copy);
+                return NULL;
+            }
+            Py_DECREF(ret);
+        }
+    }
+    else if (PyList_Check(value)) {
+        for (Py_ssize_t i = 0; i < PyList_GET_SIZE(value); i++) {
+            item = PyList_GET_ITEM(value, i);
+            PyObject *ret = plain_value(item, depth + 1);
+            if (ret && ret != item && !copy && !(copy = PyList_GetSlice(value, 0, PY_SSIZE_T_MAX)))
+                Py_CLEAR(ret);
+            if (!ret) {
+                Py_XDECREF(copy);
+                return NULL;
+            }
+            if (copy)
+                PyList_SetItem(copy, i, ret);
+            else
+                Py_DECREF(ret);
+        }
+    }
+    if (copy)
+        return copy;
+    Py_INCREF(value);
+    return value;
+}
+
+static PyObject *
+jsonlgen_plain(PyObject *module, PyObject *arg)
+{
+    return plain_value(arg, 0);
+}
+
+
+
+static PyObject *
+jsonlgen_decode(PyObject *module, PyObject *arg)
+{
+    Py_buffer view;
+    if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    const char *buf = (const char *)view.buf, *p = buf, *end = buf + view.len;
+    skip_ws(p, end);
+    PyObject *ret = decode_value(NULL, p, end, 0);
+    if (ret) {
+        skip_ws(p, end);
+        if (p != end)
+            Py_CLEAR(ret);
+    }
+    if (!ret && !PyErr_Occurred())
+        PyErr_Format(PyExc_ValueError, "Malformed json value at offset %zd",
+                     (Py_ssize_t)(p - buf));
+    PyBuffer_Release(&view);
+    return ret;
+}
+
+static PyMethodDef jsonlmodule_methods[] = {
+    {"decode", (PyCFunction)jsonlgen_decode, METH_O,
+     "decode(buffer)\n--\n\n"
+     "Decode a single json value from a buffer. Raises ValueError if it is malformed."},
+    {"plain", (PyCFunction)jsonlgen_plain, METH_O,
+     "plain(item)\n--\n\n"
+     "Copy of item where the records in it are dicts. Dicts and lists are copied\n"
+     "only if something in them changes, else item itself is returned."},
+    {NULL}
+};
 
 static struct PyModuleDef jsonlmodule = {
   PyModuleDef_HEAD_INIT,
   "jsonlgen",                  /* m_name */
   "",                      /* m_doc */
   -1,                      /* m_size */
+  jsonlmodule_methods,     /* m_methods */
 };
 
 PyMODINIT_FUNC
@@ -224,5 +1273,11 @@ PyInit_jsonlgen(void)
     Py_INCREF((PyObject *)&PyJSONLgen_Type);
     PyModule_AddObject(module, "gen", (PyObject *)&PyJSONLgen_Type);
 
+    PyRecord_Type.tp_base = &PyDict_Type;
+    if (PyType_Ready(&PyRecord_Type) < 0)
+        return NULL;
+    Py_INCREF((PyObject *)&PyRecord_Type);
+    PyModule_AddObject(module, "record", (PyObject *)&PyRecord_Type);
+
     return module;
 }
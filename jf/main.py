@@ -1,6 +1,6 @@
-from .query_parser import parse_query
+from .query_parser import compile_query, parse_query
 from .process import run_query, dotaccessible
-from .jfio import data_input, print_results
+from .jfio import BATCH_SIZE, data_input, jsonl_shards, print_results
 
 
 def jf(
@@ -16,6 +16,13 @@ def jf(
     debug,
     raw,
     init,
+    read_concurrency=1,
+    ordered_input=True,
+    source_field=None,
+    vectorize=False,
+    reorder_window=0,
+    worker_init=(),
+    start_method=None,
 ):
     """Main of the machine
 
@@ -26,10 +33,10 @@ def jf(
     ...         tmpfile.write(json.dumps(data).encode()) and True
     ...         tmpfile.flush()
     ...         jffn(tmpfile.name)
-    >>> def jffn(query, *args):
+    >>> def jffn(query, *args, **kwargs):
     ...     def _fn(fname):
-    ...         ret1 = jf(1, [query, fname], *args)
-    ...         ret2 = jf(2, [query, fname], *args)
+    ...         ret1 = jf(1, [query, fname], *args, **kwargs)
+    ...         ret2 = jf(2, [query, fname], *args, **kwargs)
     ...         assert ret1 == ret2
     ...     return _fn
     >>> run_with_data([{"a": "myvalue"}], jffn(".a", [], [], False, True, None, None, 'json', False, False, []))
@@ -51,13 +58,21 @@ def jf(
     {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a"}
     {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a"}
 
-    # Init is broken currently
-    # >>> run_with_data([{"a": "myvalue"}], jffn("{hash: hashlib.md5(.a.encode()).hexdigest(), c: C, ...}", ["hashlib"], [], False, True, None, None, 'json', False, False, ["C=5"]))
-    # {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a", "c": 5}
-    # {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a", "c": 5}
+    >>> run_with_data([{"a": "myvalue"}], jffn("{hash: hashlib.md5(.a.encode()).hexdigest(), c: C, ...}", ["hashlib"], [], False, True, None, None, 'json', False, False, ["C=5"]))
+    {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a", "c": 5}
+    {"a": "myvalue", "hash": "d724a7135ce7d2593c25fc5212d4125a", "c": 5}
+    >>> run_with_data([{"a": "myvalue"}], jffn("{c: C}", [], [], False, True, None, None, 'json', False, False, [], worker_init=["C=5"]))
+    {"c": 5}
+    {"c": 5}
     """
     import os
 
+    if debug:
+        import logging
+
+        # Reports of the input, like the number of malformed records
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+
     query = "x"
     files = []
     if len(query_and_files) > 0:
@@ -66,14 +81,14 @@ def jf(
         files = query_and_files[1:]
 
     # input query
-    queries, imports, import_path, inputfmt, init = parse_query(
+    _, _, imports, import_path, inputfmt, init, hints = compile_query(
         query,
         from_file,
         imports,
         import_path,
-        debug,
         inputfmt=inputfmt,
         init=list(init),
+        debug=debug,
     )
 
     # environment
@@ -99,12 +114,39 @@ def jf(
             )
         )
     additionals["JF_init_codes"] = [parse_query(i, dosplit=False) for i in init]
+    additionals["JF_worker_init_codes"] = [
+        parse_query(i, dosplit=False) for i in worker_init
+    ]
 
     # input data
-    data = data_input(files, additionals, inputfmt)
+    data = None
+    if processes > 1 and not listen and not source_field:
+        data = jsonl_shards(files, inputfmt, processes, hints)
+    if data is None:
+        data = data_input(
+            files,
+            additionals,
+            inputfmt,
+            batch=BATCH_SIZE,
+            concurrency=read_concurrency,
+            ordered=ordered_input,
+            source_field=source_field,
+            pushdown=hints,
+        )
 
     # processing
-    ret = run_query(query, data, additionals, from_file, processes, listen)
+    ret = run_query(
+        query,
+        data,
+        additionals,
+        from_file,
+        processes,
+        listen,
+        batched=True,
+        vectorize=vectorize,
+        reorder_window=reorder_window,
+        start_method=start_method,
+    )
 
     # output
     print_results(ret, output, compact, raw, additionals)
@@ -2,6 +2,13 @@ from abc import ABC, abstractmethod
 
 
 class JFTransformation(ABC):
+    # Whether the transformation can run on parts of the items separately, like in
+    # the worker processes with --processes
+    stateless = False
+    # Items the transformation works on at a time. The worker processes get them in
+    # chunks of a multiple of this, so that batches are not split between chunks
+    batch_size = 1
+
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
@@ -1,4 +1,19 @@
+from collections.abc import Mapping
+
+from . import jsonlgen
+
+# Limits of the work sent to the worker processes but not yet read, see Scheduler
+MAX_IN_FLIGHT = 1 << 16
+TASKS_PER_PROCESS = 4
+# Chunks of items sent to the workers are sized to take about this long and to
+# pickle to about this many bytes
+CHUNK_SECONDS = 0.02
+CHUNK_BYTES = 1 << 20
+MAX_CHUNK_SIZE = 4096
+
 _funcs = None
+# The worker pool of the last pipeline run without fork, see pipeline_pool
+_pool = None
 
 
 class DotAccessibleNone:
@@ -8,10 +23,14 @@ class DotAccessibleNone:
         return DotAccessibleNone()
 
 
-class DotAccessible(dict):
+class DotAccessible(jsonlgen.record):
     """
     Dot accessible version of a dict. For syntactic sugar.
 
+    Fields shadow the dict methods of the same name. Nested dicts are wrapped when
+    they are first read, and the wrapped dict is kept in their place, so reading a
+    field twice gives the same object. Attributes are read by jsonlgen.record.
+
     >>> it = DotAccessible({"a": 5})
     >>> it.a
     5
@@ -25,49 +44,123 @@ class DotAccessible(dict):
     {'a': 5}
     >>> DotAccessible({"a": 5}, b=1)
     {'a': 5, 'b': 1}
+    >>> it = DotAccessible({"items": {"b": None}})
+    >>> it.items is it["items"], isinstance(it.items.b, DotAccessibleNone)
+    (True, True)
+    >>> it.items.c = DotAccessibleNone()
+    >>> it
+    {'items': {'b': None, 'c': None}}
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(it)).items
+    {'b': None, 'c': None}
     """
 
-    def __init__(self, *args, **kwargs):
-        super(DotAccessible, self).__init__(*args, **kwargs)
-        for arg in args:
-            if isinstance(arg, dict):
-                for k, v in arg.items():
-                    self[k] = dotaccessible(v)
+    __slots__ = ()
+    _none = DotAccessibleNone
 
-        if kwargs:
-            for k, v in kwargs.items():
-                self[k] = dotaccessible(v)
+    def __reduce__(self):
+        return DotAccessible, (dict(self),)
 
-    def __getattr__(self, k):
-        return dotaccessible(
-            self.get(k) if not k.startswith("__") else super().__getattr__(k)
-        )
+    def __getitem__(self, k):
+        v = dict.__getitem__(self, k)
+        if v is None:
+            return DotAccessibleNone()
+        if type(v) is dict or (isinstance(v, dict) and type(v) is not DotAccessible):
+            v = DotAccessible(v)
+            dict.__setitem__(self, k, v)
+        return v
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
 
     def __setattr__(self, key, value):
-        self.__setitem__(key, value)
+        self[key] = value
 
     def __setitem__(self, key, value):
-        super(DotAccessible, self).__setitem__(key, value)
-        self.__dict__.update({key: value})
+        if isinstance(value, DotAccessibleNone):
+            value = None
+        dict.__setitem__(self, key, value)
 
     def __delattr__(self, item):
-        self.__delitem__(item)
+        del self[item]
+
 
-    def __delitem__(self, key):
-        super(DotAccessible, self).__delitem__(key)
-        del self.__dict__[key]
+class LazyRecord(Mapping):
+    """
+    Json object whose fields are decoded when they are first read
 
+    Made by jsonlgen.gen(..., lazy=LazyRecord) from the raw json of a record and the
+    (start, end) offsets of its fields. Fields are read as from a DotAccessible. Only
+    the filters at the start of a query see these, see materialized.
 
-def undotaccessible(it):
-    if isinstance(it, dict):
-        return {k: undotaccessible(v) for k, v in dict.items(it)}
-    if isinstance(it, list):
-        return [undotaccessible(v) for v in it]
-    if isinstance(it, DotAccessibleNone):
-        return None
+    >>> it = LazyRecord(b'{"a": {"b": 1}, "c": [2]}', {"a": (6, 14), "c": (21, 24)})
+    >>> it.a.b, it["c"], it.get("d"), isinstance(it.d, DotAccessibleNone), len(it)
+    (1, [2], None, True, 2)
+    >>> it.materialize()
+    {'a': {'b': 1}, 'c': [2]}
+    """
+
+    __slots__ = ("_raw", "_index", "_values")
+
+    def __init__(self, raw, index):
+        self._raw = raw
+        self._index = index
+        self._values = {}
+
+    def __getitem__(self, k):
+        if k in self._values:
+            return self._values[k]
+        from . import jsonlgen
+
+        start, end = self._index[k]
+        value = jsonlgen.decode(memoryview(self._raw)[start:end])
+        self._values[k] = value = dotaccessible(value)
+        return value
+
+    def __getattr__(self, k):
+        if k.startswith("__"):
+            raise AttributeError(k)
+        try:
+            return self[k]
+        except KeyError:
+            return DotAccessibleNone()
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def materialize(self):
+        from . import jsonlgen
+
+        return jsonlgen.decode(self._raw)
+
+
+def materialized(it):
+    """Decode a LazyRecord, other items are returned as they are"""
+    if type(it) is LazyRecord:
+        return it.materialize()
     return it
 
 
+def undotaccessible(it):
+    """
+    Plain python version of an item
+
+    The DotAccessible dicts in it are copied to dicts, as their fields can shadow
+    the items method which the json and yaml outputs call. Other dicts and lists are
+    copied only if something in them is. The json and yaml outputs write
+    DotAccessibleNone as null.
+
+    >>> it = [{"a": 1}, DotAccessible({"items": 2, "keys": {"get": 3}})]
+    >>> plain = undotaccessible(it)
+    >>> plain, plain[0] is it[0], type(plain[1]), type(plain[1]["keys"])
+    ([{'a': 1}, {'items': 2, 'keys': {'get': 3}}], True, <class 'dict'>, <class 'dict'>)
+    """
+    return jsonlgen.plain(it)
+
+
 def dotaccessible(it):
     if it is None:
         return DotAccessibleNone()
@@ -76,78 +169,511 @@ def dotaccessible(it):
     return it
 
 
-def worker_init(funcs):
-    """
-    initializer for the worker in multiprocessing
-    """
-    global _funcs
-    _funcs = funcs
+def asdotaccessible(it):
+    """dotaccessible which returns a DotAccessible as it is instead of a copy"""
+    if isinstance(it, DotAccessible):
+        return it
+    return dotaccessible(it)
 
 
 class JFREMOVED:
     pass
 
 
+def _kept(x):
+    return x is not JFREMOVED
+
+
+def fuse(fs, inputs=None):
+    """
+    Fuse consecutive map, update and filter stages into one function of an item
+
+    The item is made dot accessible once and is then passed from stage to stage as
+    it is. A DotAccessible item is copied only before the first update, so the items
+    of earlier stages are never changed, and the updates are then done in place on
+    that copy. The output of a map stage is a new item. Returns JFREMOVED for items
+    which a filter removes.
+
+    With inputs, the ids of the items given to the pipeline (see track_inputs), only
+    those are copied. The other DotAccessible items were made by the earlier stages
+    of the pipeline, which do not use them any more.
+
+    >>> f = fuse([["filter", lambda x: x.a > 1],
+    ...           ["update", lambda x: {"b": x.a * 2}],
+    ...           ["map", lambda x: x.b + 1]])
+    >>> f({"a": 1}) is JFREMOVED, f({"a": 2})
+    (True, 5)
+    >>> f = fuse([["update", lambda x: {"b": {"c": x.a}}], ["filter", lambda x: x.b.c]])
+    >>> f({"a": 1})
+    {'a': 1, 'b': {'c': 1}}
+    >>> it = DotAccessible({"a": 1})
+    >>> fuse([["filter", lambda x: x.a]])(it) is it, f(it), it
+    (True, {'a': 1, 'b': {'c': 1}}, {'a': 1})
+    >>> f = fuse([["update", lambda x: {"b": 2}]], inputs=set())
+    >>> f(it) is it, it
+    (True, {'a': 1, 'b': 2})
+    """
+    env = {
+        "DotAccessible": DotAccessible,
+        "JFREMOVED": JFREMOVED,
+        "LazyRecord": LazyRecord,
+        "asdotaccessible": asdotaccessible,
+        "dotaccessible": dotaccessible,
+    }
+    if inputs is None:
+        lines = ["shared = isinstance(x, DotAccessible)"]
+    else:
+        env["inputs"] = inputs
+        lines = ["shared = id(x) in inputs"]
+    lines.append("x = asdotaccessible(x)")
+    # Items may be LazyRecords until the first stage which is not a filter
+    lazy = True
+    # Whether x is surely a copy made here, which can be updated in place
+    owned = False
+    for i, (op, _f) in enumerate(fs):
+        env[f"f{i}"] = _f
+        if lazy and op != "filter":
+            lines += [
+                "if isinstance(x, LazyRecord):",
+                "    x = dotaccessible(x.materialize())",
+            ]
+            lazy = False
+        if op == "map" and i == len(fs) - 1:
+            lines.append(f"x = f{i}(x)")
+        elif op == "map":
+            lines.append(f"x = dotaccessible(f{i}(x))")
+            owned = True
+        elif op == "update":
+            if not owned:
+                lines += ["if shared:", "    x = DotAccessible(x)"]
+                owned = True
+            lines += [f"for k, v in f{i}(x).items():", "    x[k] = v"]
+        elif op == "filter":
+            lines += [f"if not f{i}(x):", "    return JFREMOVED"]
+    if lazy:
+        lines += ["if isinstance(x, LazyRecord):", "    x = x.materialize()"]
+    lines.append("return x")
+    exec("def fused(x):\n" + "".join(f"    {line}\n" for line in lines), env)
+    return env["fused"]
+
+
+def track_inputs(arr, inputs):
+    """Items of arr, with the ids of the DotAccessible ones added to inputs, see fuse"""
+    for x in arr:
+        if isinstance(x, DotAccessible):
+            inputs.add(id(x))
+        yield x
+
+
+def batches(arr, size):
+    """Lists of up to size items of arr"""
+    from itertools import islice
+
+    arr = iter(arr)
+    return iter(lambda: list(islice(arr, size)), [])
+
+
+def fused_batch(fused, items):
+    """Run fused stages (see fuse) on a list of items"""
+    return list(filter(_kept, map(fused, items)))
+
+
+def function_batch(transformation, items):
+    """Run a function stage on a list of items"""
+    return list(transformation(map(asdotaccessible, map(materialized, items))))
+
+
+def batch_stages(fs):
+    """
+    Functions of a list of items, which run the stages fs on them in order
+
+    Consecutive map, update and filter stages are fused, see fuse. The items are
+    taken to be the pipeline's own, like the ones unpickled in a worker process.
+
+    >>> [f([{"a": 1}, {"a": 2}]) for f in batch_stages([["filter", lambda x: x.a > 1]])]
+    [[{'a': 2}]]
+    """
+    from functools import partial
+    from itertools import groupby
+
+    ret = []
+    for stateless, stages in groupby(fs, lambda it: it[0] != "function"):
+        if stateless:
+            ret.append(partial(fused_batch, fuse(list(stages), inputs=())))
+        else:
+            ret += [partial(function_batch, _f(1)) for _, _f in stages]
+    return ret
+
+
+def poolable(stage):
+    """Whether a function stage can run in the worker processes, see JFTransformation"""
+    return getattr(stage(1), "stateless", False)
+
+
+def chunk_size(stages):
+    """
+    Smallest chunk of items for the stages in the worker processes, the largest
+    batch_size of their function stages (see JFTransformation)
+
+    >>> from jf.extra_functions import BatchMap
+    >>> chunk_size([["map", lambda x: x], ["function", lambda x: BatchMap(len, size=8)]])
+    8
+    """
+    sizes = [getattr(_f(1), "batch_size", 1) for op, _f in stages if op == "function"]
+    return max(sizes, default=1)
+
+
+def item_map(stage):
+    """Map stage from a function stage which only maps the items, like .a"""
+    fn = stage(1)
+    return lambda x: next(fn((x,)))
+
+
+def plan(fs):
+    """
+    Split the stages fs into segments for multiprocessing
+
+    Returns a list of (pooled, stages). Pooled segments can run on any part of the
+    items in the worker processes. The others are the stateful stages between them,
+    like sorted and first, which run in the parent process.
+
+    >>> from jf.extra_functions import BatchMap, Sorted
+    >>> [(pooled, [op for op, _ in stages]) for pooled, stages in plan([
+    ...     ["map", lambda x: x], ["function", lambda x: Sorted(lambda x: x.a)],
+    ...     ["filter", lambda x: x], ["function", lambda x: BatchMap(len)]])]
+    [(True, ['map']), (False, ['function']), (True, ['filter', 'function'])]
+    """
+    from itertools import groupby
+
+    stages = groupby(fs, lambda it: it[0] != "function" or poolable(it[1]))
+    return [(pooled, list(segment)) for pooled, segment in stages]
+
+
+def run_init(codes, world):
+    """
+    Run initialization code, like --init, in world
+
+    >>> world = {}
+    >>> run_init(["import math", "C = math.floor(5.5)"], world)
+    >>> world["C"]
+    5
+    """
+    for code in codes:
+        exec(code, world)
+
+
+def worker_init(segments, init=None, pipeline=None):
+    """
+    initializer for the worker in multiprocessing
+
+    Each segment is a list of stages, see plan. Workers run the segment given to
+    batch_worker. init is called first, see mymap. With a pipeline (see Pipeline),
+    the worker compiles the segments and init from it.
+    """
+    global _funcs
+    if pipeline is not None:
+        fs, _, init = pipeline.stages(processes=2)
+        segments = [stages for pooled, stages in plan(fs) if pooled]
+    if init:
+        init()
+    _funcs = [batch_stages(funcs) for funcs in segments]
+
+
 def worker(x):
     """
     worker for multiprocessing
-    >>> worker_init([["map", lambda x: x],
-    ...              ["update", lambda x: x],
-    ...              ["function", lambda x: lambda y: y],
-    ...              ["filter", lambda x: x]])
+    >>> worker_init([[["map", lambda x: x],
+    ...               ["update", lambda x: x],
+    ...               ["function", lambda x: lambda y: y],
+    ...               ["filter", lambda x: x]]])
     >>> worker({"a": 1})
     {'a': 1}
     """
-    for op, _func in _funcs:
-        if op == "map":
-            x = _func(dotaccessible(x))
-        elif op == "update":
-            x.update(_func(dotaccessible(x)))
-        elif op == "function":
-            x = _func(dotaccessible(x))(dotaccessible(x))
-        elif op == "filter":
-            test = _func(dotaccessible(x))
-            if not test:
-                return JFREMOVED
-    return x
+    ret = batch_worker([x])
+    return ret[0] if ret else JFREMOVED
+
+
+def batch_worker(xs, segment=0):
+    """
+    worker for multiprocessing a batch of items
+    >>> worker_init([[["filter", lambda x: x.a > 1]], [["map", lambda x: x.a]]])
+    >>> batch_worker([{"a": 1}, {"a": 2}])
+    [{'a': 2}]
+    >>> batch_worker([{"a": 1}, {"a": 2}], segment=1)
+    [1, 2]
+    """
+    for fn in _funcs[segment]:
+        xs = fn(xs)
+    return xs
+
+
+def shard_worker(shard):
+    """
+    worker for multiprocessing a byte range of a jsonl file
+    """
+    from .jfio import read_shard
+
+    return batch_worker(read_shard(shard))
+
+
+def timed_worker(work, *args):
+    """
+    Run work in a worker process, returning its run time and pickled results
+
+    >>> import pickle
+    >>> elapsed, ret = timed_worker(sorted, [2, 1])
+    >>> pickle.loads(ret)
+    [1, 2]
+    """
+    import pickle
+    from time import perf_counter
+
+    start = perf_counter()
+    ret = pickle.dumps(work(*args), pickle.HIGHEST_PROTOCOL)
+    return perf_counter() - start, ret
+
+
+class Scheduler:
+    """
+    Run the segments of a pipeline (see plan) in a multiprocessing pool
+
+    The input is read only as fast as the results are: at most MAX_IN_FLIGHT items,
+    and TASKS_PER_PROCESS chunks of them per process, are sent to the workers before
+    their results are read. The chunk size follows the time the workers take and
+    the pickled size of the results per item, see CHUNK_SECONDS and CHUNK_BYTES.
+
+    The results are in the order of the input, or at most reorder_window items out
+    of it, so that a slow chunk does not hold back the ones after it. With an
+    infinite window the results are yielded as they are ready. Shards are counted as
+    one item each.
+
+    >>> from multiprocessing import Pool
+    >>> stages = [["map", lambda x: x.a]]
+    >>> with Pool(2, initializer=worker_init, initargs=([stages],)) as pool:
+    ...     list(Scheduler(pool, 2).map({"a": i} for i in range(50)))[-3:]
+    ...     unordered = Scheduler(pool, 2, float("inf"))
+    ...     sorted(unordered.map({"a": i} for i in range(50)))[-3:]
+    [47, 48, 49]
+    [47, 48, 49]
+    """
+
+    def __init__(self, pool, processes, reorder_window=0):
+        self.pool = pool
+        self.max_tasks = TASKS_PER_PROCESS * processes
+        self.reorder_window = reorder_window
+        self.size = 16
+        # Chunks sent to the workers whose results were not read yet
+        self.unread = 0
 
+    def map(self, arr, segment=0, min_size=1):
+        """
+        Results of running the segment on items of arr
 
-def dict_updater(_f):
-    def _update_dict(x):
-        return dict(x, **_f(x))
+        The chunks are a multiple of min_size items, so that batches of that size
+        (see chunk_size) are not split between them.
+        """
+        from itertools import islice
 
-    return _update_dict
+        arr = iter(arr)
 
+        def tasks():
+            while True:
+                size = max(self.size, min_size)
+                chunk = list(islice(arr, size - size % min_size))
+                if not chunk:
+                    return
+                yield (batch_worker, chunk, segment), len(chunk)
+
+        return self._run(tasks())
+
+    def shards(self, shards):
+        """Results of reading and running the first segment on the shards"""
+        return self._run(((shard_worker, shard), 0) for shard in shards)
+
+    def close(self):
+        """
+        Stop the work whose results were not read, like when the reader stopped
+        early, by terminating the pool (see discard_pool)
+        """
+        if self.unread:
+            discard_pool(self.pool)
+
+    def _run(self, tasks):
+        from queue import SimpleQueue
+
+        # The pending chunks by their position in the input, in input order
+        pending = {}
+        ready = set()
+        done = SimpleQueue()
+        position = 0
+        for task, n in tasks:
+            while pending and (
+                len(pending) >= self.max_tasks
+                or sum(m for m, _ in pending.values()) + n > MAX_IN_FLIGHT
+            ):
+                yield from self._read(*pending.pop(self._next(pending, ready, done)))
+            pending[position] = n, self.pool.apply_async(
+                timed_worker,
+                task,
+                callback=lambda _, position=position: done.put(position),
+                error_callback=lambda _, position=position: done.put(position),
+            )
+            self.unread += 1
+            position += max(n, 1)
+        while pending:
+            yield from self._read(*pending.pop(self._next(pending, ready, done)))
+
+    def _next(self, pending, ready, done):
+        """Wait for a finished chunk which is within the reorder window"""
+        while True:
+            first = next(iter(pending))
+            for position in ready:
+                n = pending[position][0]
+                if position == first or position + n - first <= self.reorder_window:
+                    ready.remove(position)
+                    return position
+            ready.add(done.get())
+
+    def _read(self, n, result):
+        import pickle
+
+        self.unread -= 1
+        elapsed, ret = result.get()
+        if n:
+            by_time = CHUNK_SECONDS * n / max(elapsed, 1e-6)
+            by_bytes = CHUNK_BYTES * n / max(len(ret), 1)
+            self.size = max(1, min(int(by_time), int(by_bytes), MAX_CHUNK_SIZE))
+            if 0 < self.reorder_window < 2 * MAX_CHUNK_SIZE:
+                # Chunks as large as the reorder window could not be reordered
+                self.size = max(1, min(self.size, int(self.reorder_window) // 2))
+        return pickle.loads(ret)
+
+
+def pipeline_pool(context, processes, pipeline):
+    """
+    Pool of worker processes for running a pipeline (see Pipeline), started with
+    context (see multiprocessing.get_context)
 
-def mymap(fs, arr, processes=1):
+    The pool is kept for running the same pipeline again, so that the workers are
+    started and the pipeline is compiled in them only once. A pool for another
+    pipeline replaces it.
+    """
+    import pickle
+
+    global _pool
+    key = context.get_start_method(), processes, pickle.dumps(pipeline)
+    if _pool is not None and _pool[0] == key:
+        return _pool[1]
+    if _pool is not None:
+        _pool[1].terminate()
+    initargs = None, None, pipeline
+    pool = context.Pool(processes, initializer=worker_init, initargs=initargs)
+    _pool = key, pool
+    return pool
+
+
+def discard_pool(pool):
+    """Terminate pool, and drop it if it is the one kept by pipeline_pool"""
+    global _pool
+    if _pool is not None and _pool[1] is pool:
+        _pool = None
+    pool.terminate()
+
+
+def mymap(
+    fs,
+    arr,
+    processes=1,
+    batched=False,
+    reorder_window=0,
+    init=None,
+    pipeline=None,
+    start_method=None,
+):
     """My mapping function
 
     Apply functions in fs to items in arr. Also supports multiprocessing.
-
+    If batched is set, arr yields lists of items instead of items. If arr has
+    shards (see jfio.JsonlShards), the workers read and parse the shards
+    themselves. With multiprocessing the results of the stateless stages may be
+    reorder_window items out of order, see Scheduler, and init is called in each
+    worker process before it runs any stages.
+
+    The worker processes are started with start_method, or the default one of
+    multiprocessing. With fork they are started after the objects made so far, like
+    models loaded with --init, are frozen with gc.freeze. The garbage collector of
+    the workers then leaves them untouched, and their memory stays shared with the
+    parent instead of being copied to each worker. With spawn and forkserver, the
+    workers compile the pipeline fs was compiled from again (see Pipeline), and the
+    pool is kept for the next run of the same pipeline (see pipeline_pool), unless
+    the run stopped before all the work sent to the workers was read.
+
+    >>> list(mymap([["filter", lambda x: x.a > 1]], [[{"a": 1}, {"a": 2}], [{"a": 3}]], batched=True))
+    [{'a': 2}, {'a': 3}]
+    >>> from jf.extra_functions import First
+    >>> it = DotAccessible({"a": 1})
+    >>> fs = [["filter", lambda x: x.a], ["function", lambda x: First(lambda x: 1)],
+    ...       ["update", lambda x: {"b": 2}]]
+    >>> list(mymap(fs, [it])), it
+    ([{'a': 1, 'b': 2}], {'a': 1})
     """
+    from itertools import chain, groupby
+
     if processes > 1:
-        from multiprocessing import Pool
-
-        with Pool(
-            processes,
-            initializer=worker_init,
-            initargs=([(op, f) for op, f in fs if op != "function"],),
-        ) as pool:
-            ret = pool.imap(worker, arr, chunksize=16)
-            for op, f in fs:
-                if op == "function":
-                    ret = f(ret)(map(dotaccessible, ret))
-            yield from filter(lambda x: x != JFREMOVED, ret)
+        import gc
+        from contextlib import nullcontext
+        from multiprocessing import get_context
+
+        # Only the stateful stages run in the parent, see plan
+        segments = plan(fs)
+        pooled = [stages for is_pooled, stages in segments if is_pooled]
+        context = get_context(start_method)
+        if pipeline is not None and context.get_start_method() != "fork":
+            pool = nullcontext(pipeline_pool(context, processes, pipeline))
+        else:
+            gc.freeze()
+            try:
+                pool = context.Pool(
+                    processes, initializer=worker_init, initargs=(pooled, init)
+                )
+            finally:
+                gc.unfreeze()
+        with pool as pool:
+            scheduler = Scheduler(pool, processes, reorder_window)
+            segment = 0
+            for is_pooled, stages in segments:
+                if segment == 0 and is_pooled and hasattr(arr, "shards"):
+                    arr = scheduler.shards(arr.shards())
+                    batched = False
+                    segment += 1
+                    continue
+                if batched:
+                    arr, batched = chain.from_iterable(arr), False
+                if is_pooled:
+                    arr = scheduler.map(arr, segment, chunk_size(stages))
+                    segment += 1
+                    continue
+                for _, _f in stages:
+                    arr = _f(1)(map(asdotaccessible, map(materialized, arr)))
+            if batched:
+                arr = chain.from_iterable(arr)
+            try:
+                yield from arr
+            finally:
+                # Like after first(2), or when the results are no longer read
+                scheduler.close()
     else:
-        for op, _f in fs:
-            if op == "map":
-                arr = map(_f, map(dotaccessible, arr))
-            elif op == "update":
-                arr = map(dict_updater(_f), map(dotaccessible, arr))
-            elif op == "function":
-                arr = _f(1)(map(dotaccessible, arr))
-            elif op == "filter":
-                arr = filter(_f, map(dotaccessible, arr))
+        if batched:
+            arr = chain.from_iterable(arr)
+        inputs = set()
+        arr = track_inputs(arr, inputs)
+        # Consecutive stateless stages run as one function, see fuse
+        for stateless, stages in groupby(fs, lambda it: it[0] != "function"):
+            if stateless:
+                arr = filter(_kept, map(fuse(list(stages), inputs), arr))
+                continue
+            for _, _f in stages:
+                arr = _f(1)(map(asdotaccessible, map(materialized, arr)))
         yield from arr
 
 
@@ -222,72 +748,163 @@ def HttpServe(fs, listen, processes):
     @app.route("/", methods=["POST", "PUT"])
     def index():
         data.append(request.json)
-        arr = [request.json]
-        for op, _f in fs:
-            if op == "map":
-                arr = map(_f, map(dotaccessible, arr))
-            elif op == "update":
-                arr = map(dict_updater(_f), map(dotaccessible, arr))
-            elif op == "function":
-                arr = _f(1)(map(dotaccessible, arr))
-            elif op == "filter":
-                arr = filter(_f, map(dotaccessible, arr))
-        ret = undotaccessible(next(arr))
+        from .jfio import StructEncoder
+
+        ret = undotaccessible(next(mymap(fs, [request.json])))
         results.append(ret)
-        return json.dumps(ret)
+        return json.dumps(ret, cls=StructEncoder)
 
     app.run(host="0.0.0.0", port=listen)
 
 
-def run_query(query, data, additionals={}, from_file=False, processes=1, listen=False):
+class Pipeline:
     """
-    Run query. This function will utilize global imports if used as a library:
+    A query with its additionals (see run_query), which can be pickled and compiled
+    again, like in worker processes started with spawn or forkserver
 
-    >>> import hashlib
-    >>> list(run_query('.a', [{"a": "521"}, {"a": "643"}]))
-    ['521', '643']
-    """
-    from .query_parser import parse_query
-    from . import extra_functions
-
-    # query
-    queries, imports, import_path, _, _ = parse_query(query, from_file, [], [], False)
+    Modules in the additionals, like the ones from --import, are pickled by their
+    names and imported again.
 
-    name_alternatives = {
-        "first": ["head"],
-        "last": ["tail"],
-        "firstnlast": ["headntail"],
-    }
-
-    # environment
-    world = dict(
-        {"data": data, "mymap": mymap},
-        **{
-            camel_to_snake(k): getattr(extra_functions, orig_k)
-            for orig_k in dir(extra_functions)
-            if orig_k[0] != "_"
-            for k in name_alternatives.get(camel_to_snake(orig_k), []) + [orig_k]
-        },
-    )
-    if additionals:
-        world.update(additionals)
-    else:
-        import inspect
-
-        def superglobals():
-            _globals = dict(
-                inspect.getmembers(inspect.stack()[len(inspect.stack()) - 1][0])
-            )["f_globals"]
-            return _globals
+    >>> import math, pickle
+    >>> additionals = {"math": math, "JF_init_codes": ["C = 2"]}
+    >>> pipeline = Pipeline("{a: math.floor(.a) * C}", additionals=additionals)
+    >>> pipeline = pickle.loads(pickle.dumps(pipeline))
+    >>> pipeline.additionals["math"] is math
+    True
+    >>> fs, queries, init = pipeline.stages()
+    >>> list(mymap(fs, [{"a": 1.5}]))
+    [{'a': 2}]
+    """
 
-        world.update({k: v for k, v in superglobals().items() if "_" != k[0]})
+    def __init__(self, query, from_file=False, additionals={}):
+        self.query = query
+        self.from_file = from_file
+        self.additionals = additionals
+
+    def __getstate__(self):
+        from types import ModuleType
+
+        values, modules = {}, {}
+        for k, v in self.additionals.items():
+            if isinstance(v, ModuleType):
+                modules[k] = v.__name__
+            else:
+                values[k] = v
+        return self.query, self.from_file, values, modules
+
+    def __setstate__(self, state):
+        import importlib
+
+        self.query, self.from_file, self.additionals, modules = state
+        for k, v in modules.items():
+            self.additionals[k] = importlib.import_module(v)
+
+    def stages(self, processes=1, data=None):
+        """
+        Compile the query to its stages, after running the init codes
+
+        Returns the stages, the query source from compile_query and a function which
+        runs the worker init codes in each worker process, see run_query.
+        """
+        from functools import partial
+
+        from .query_parser import compile_query
+        from . import extra_functions
+
+        additionals = self.additionals
+
+        # query
+        code, queries = compile_query(self.query, self.from_file, [], [])[:2]
+
+        name_alternatives = {
+            "first": ["head"],
+            "last": ["tail"],
+            "firstnlast": ["headntail"],
+        }
+
+        # environment
+        world = dict(
+            {"data": data, "mymap": mymap},
+            **{
+                camel_to_snake(k): getattr(extra_functions, orig_k)
+                for orig_k in dir(extra_functions)
+                if orig_k[0] != "_"
+                for k in name_alternatives.get(camel_to_snake(orig_k), []) + [orig_k]
+            },
+        )
+        if additionals:
+            world.update(additionals)
+        else:
+            import inspect
+
+            def superglobals():
+                _globals = dict(
+                    inspect.getmembers(inspect.stack()[len(inspect.stack()) - 1][0])
+                )["f_globals"]
+                return _globals
+
+            world.update({k: v for k, v in superglobals().items() if "_" != k[0]})
+
+        run_init(additionals.get("JF_init_codes", []), world)
+        worker_init_codes = additionals.get("JF_worker_init_codes", [])
+        init = None
+        if processes > 1 and worker_init_codes:
+            init = partial(run_init, worker_init_codes, world)
+        else:
+            run_init(worker_init_codes, world)
+
+        fs = eval(code, world)
+        if processes > 1:
+            from .query_parser import query_stages
+
+            # Function stages which only map the items can run in the worker processes
+            fs = [
+                ("map", item_map(f)) if op == "function" and qtype == "map" else (op, f)
+                for (op, f), (qtype, _) in zip(fs, query_stages(queries))
+            ]
+        return fs, queries, init
+
+
+def run_query(
+    query,
+    data,
+    additionals={},
+    from_file=False,
+    processes=1,
+    listen=False,
+    batched=False,
+    vectorize=False,
+    reorder_window=0,
+    start_method=None,
+):
+    """
+    Run query. This function will utilize global imports if used as a library.
+    If batched is set, data yields lists of items (see jfio.data_input). If
+    vectorize is set, the stages which can be are run on columns of the items of a
+    batch at a time (see vectorized.vector_map). For reorder_window and
+    start_method, see mymap.
 
-    for init in additionals.get("JF_init_codes", []):
-        eval(init, world)
+    The JF_init_codes of additionals are run once before the query. With
+    multiprocessing, the JF_worker_init_codes are run in each worker process, and
+    otherwise with the JF_init_codes.
 
+    >>> import hashlib
+    >>> list(run_query('.a', [{"a": "521"}, {"a": "643"}]))
+    ['521', '643']
+    >>> list(run_query('{b: .a * 2, ...}, (.b > 2)', [{"a": 1}, {"a": 2}], vectorize=True))
+    [{'a': 2, 'b': 4}]
+    """
+    pipeline = Pipeline(query, from_file, additionals)
+    fs, queries, init = pipeline.stages(processes, data)
     if listen:
-        world.update({"HttpServe": HttpServe})
-        return eval(f"HttpServe({queries}, {listen}, {processes})", world)
-    else:
-        # process
-        return eval(f"mymap({queries}, data, {processes})", world)
+        return HttpServe(fs, listen, processes)
+    if vectorize and processes == 1:
+        from .vectorized import vector_map, vector_stages
+
+        stages = vector_stages(queries)
+        if stages and any(stages):
+            return vector_map(fs, stages, data, batched)
+    # process
+    return mymap(
+        fs, data, processes, batched, reorder_window, init, pipeline, start_method
+    )
@@ -1,3 +1,6 @@
+import ast
+
+
 def split_query(q):
     """
     Split input query into components
@@ -170,3 +173,469 @@ def parse_query(
 
         sys.stderr.write(queries + "\n")
     return queries, imports, import_path, inputfmt, init
+
+
+QUERY_CACHE_VERSION = 1
+# Compiled queries kept on disk, the least recently used ones are removed over this
+QUERY_CACHE_SIZE = 1000
+_compiled = {}
+
+
+def query_cache_dir():
+    """
+    Directory of the compiled query cache
+
+    Set by JF_CACHE_DIR, which disables the cache when empty, and ~/.cache/jf by default.
+    """
+    import os
+
+    ret = os.environ.get("JF_CACHE_DIR")
+    if ret is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        ret = os.path.join(cache_home, "jf")
+    return ret
+
+
+def query_cache_trusted(path):
+    """
+    Whether the code cached at path (a file, directory or open file descriptor) can be
+    loaded: it must be owned by the user and not writable by others
+
+    >>> import os, tempfile
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     trusted = query_cache_trusted(tmp)
+    ...     os.chmod(tmp, 0o777)
+    ...     trusted, query_cache_trusted(tmp)
+    (True, False)
+    """
+    import os
+    import stat
+
+    st = os.stat(path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def evict_query_cache(cache_dir, size=QUERY_CACHE_SIZE):
+    """
+    Remove the least recently used compiled queries over size from cache_dir
+
+    >>> import os, tempfile
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     for i in range(3):
+    ...         open(os.path.join(tmp, f"{i}.marshal"), "w").close()
+    ...         os.utime(os.path.join(tmp, f"{i}.marshal"), (i, i))
+    ...     evict_query_cache(tmp, 2)
+    ...     sorted(os.listdir(tmp))
+    ['1.marshal', '2.marshal']
+    """
+    import os
+
+    entries = [it for it in os.scandir(cache_dir) if it.name.endswith(".marshal")]
+    if len(entries) <= size:
+        return
+    entries.sort(key=lambda it: it.stat().st_mtime_ns)
+    for it in entries[: len(entries) - size]:
+        try:
+            os.remove(it.path)
+        except OSError:
+            pass
+
+
+def query_cache_key(query, from_file):
+    """
+    Key of a query in the compiled query cache
+
+    Changes with the query, the .jf file the query is read from, this module and the
+    python version and bytecode (importlib.util.MAGIC_NUMBER), as the cached code only
+    loads in the interpreter which compiled it.
+    """
+    import hashlib
+    import os
+    import sys
+    from importlib.util import MAGIC_NUMBER
+
+    parts = [QUERY_CACHE_VERSION, sys.version, sys.implementation.cache_tag]
+    parts += [MAGIC_NUMBER, query, bool(from_file)]
+    files = [__file__]
+    if from_file or query.endswith(".jf"):
+        files.append(query)
+    for fn in files:
+        stat = os.stat(fn)
+        parts.append((os.path.abspath(fn), stat.st_mtime_ns, stat.st_size))
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def compile_query(
+    query,
+    from_file=None,
+    imports=[],
+    import_path=None,
+    inputfmt=None,
+    init=[],
+    debug=False,
+):
+    """
+    Parse and compile a query
+
+    Returns the results of parse_query with the compiled code of the query and its
+    pushdown, as (code, queries, imports, import_path, inputfmt, init, pushdown).
+    Evaluating the code gives the list of query stages. Compiled queries are cached in
+    memory and on disk (see query_cache_dir), so that running the same query or .jf file
+    again skips parsing and compiling it. With debug the caches are not used. The disk
+    cache keeps QUERY_CACHE_SIZE queries, and is only read if it is trusted (see
+    query_cache_trusted), as loading it runs its code.
+
+    >>> code, queries, *_ = compile_query("(.a > 1), .b")
+    >>> [qtype for qtype, _ in eval(code)]
+    ['filter', 'function']
+    >>> compile_query("(.a > 1), .b")[0] is code
+    True
+    """
+    import marshal
+    import os
+
+    try:
+        key = None if debug else query_cache_key(query, from_file)
+    except OSError:
+        key = None
+    ret = _compiled.get(key)
+    cache_dir = query_cache_dir()
+    cache_fn = os.path.join(cache_dir, key + ".marshal") if key and cache_dir else None
+    try:
+        if cache_fn and not query_cache_trusted(cache_dir):
+            cache_fn = None
+    except OSError:
+        pass
+    if ret is None and cache_fn:
+        try:
+            with open(cache_fn, "rb") as f:
+                if query_cache_trusted(f.fileno()):
+                    ret = marshal.load(f)
+            # The modification time orders the queries for evict_query_cache
+            os.utime(cache_fn)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+    if ret is None:
+        # The options from a .jf file are cached and the given ones added below
+        queries, *parsed = parse_query(query, from_file, [], [], debug, init=[])
+        tree = ast.parse(queries, filename="<jf query>", mode="eval")
+        code = compile(tree, "<jf query>", "eval")
+        ret = (code, queries, *parsed, pushdown(queries))
+        if cache_fn:
+            try:
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                tmp_fn = f"{cache_fn}.{os.getpid()}"
+                with open(tmp_fn, "wb") as f:
+                    marshal.dump(ret, f)
+                os.replace(tmp_fn, cache_fn)
+                evict_query_cache(cache_dir)
+            except (OSError, ValueError):
+                pass
+    if key:
+        _compiled[key] = ret
+    code, queries, file_imports, file_import_path, file_inputfmt, file_init, hints = ret
+    if file_import_path:
+        import_path = list(import_path or []) + file_import_path
+    return (
+        code,
+        queries,
+        list(imports) + file_imports,
+        import_path,
+        file_inputfmt or inputfmt,
+        list(init) + file_init,
+        hints,
+    )
+
+
+DICT_METHODS = set(dir(dict))
+
+
+def query_stages(queries):
+    """
+    Parse the pipeline source from parse_query into (type, expression) pairs
+
+    Expressions are the ast nodes of the stage bodies, as functions of x. Function
+    stages that only map items, like ".a" at the end of a query, are returned as maps.
+
+    >>> [(t, ast.unparse(e)) for t, e in query_stages(parse_query("(.a > 1), .b")[0])]
+    [('filter', 'x.a > 1'), ('map', 'x.b')]
+    """
+    stages = []
+    for stage in ast.parse(queries, mode="eval").body.elts:
+        qtype, func = stage.elts[0].value, stage.elts[1]
+        body = func.body
+        if qtype == "function" and _is_map_function(body):
+            qtype, body = "map", body.body.args[0].body
+        stages.append((qtype, body))
+    return stages
+
+
+def _is_map_function(node):
+    """Match lambda y: map(lambda x: ..., y)"""
+    return (
+        isinstance(node, ast.Lambda)
+        and isinstance(node.body, ast.Call)
+        and isinstance(node.body.func, ast.Name)
+        and node.body.func.id == "map"
+        and len(node.body.args) == 2
+        and isinstance(node.body.args[0], ast.Lambda)
+        and [a.arg for a in node.body.args[0].args.args] == ["x"]
+    )
+
+
+def field_paths(node):
+    """
+    Paths of the item fields an expression of x reads
+
+    Returns a set of tuples of keys, or None if the expression may use the item as
+    a whole. Methods called on a field are not part of its path.
+
+    >>> sorted(field_paths(ast.parse('x.a.b + len(x.c.strip()) + x["d"] + x.get("e")').body[0].value))
+    [('a', 'b'), ('c',), ('d',), ('e',)]
+    >>> field_paths(ast.parse('f(x)').body[0].value) is None
+    True
+    """
+    parents = {
+        child: parent for parent in ast.walk(node) for child in ast.iter_child_nodes(parent)
+    }
+    paths = set()
+    for name in ast.walk(node):
+        if isinstance(name, ast.arg) and name.arg == "x":
+            # x is rebound by a nested lambda
+            return None
+        if not (isinstance(name, ast.Name) and name.id == "x"):
+            continue
+        if not isinstance(name.ctx, ast.Load):
+            return None
+        path, cur = [], name
+        while True:
+            parent = parents.get(cur)
+            if isinstance(parent, ast.Attribute):
+                path.append(parent.attr)
+            elif (
+                isinstance(parent, ast.Subscript)
+                and parent.value is cur
+                and isinstance(parent.slice, ast.Constant)
+                and isinstance(parent.slice.value, str)
+            ):
+                path.append(parent.slice.value)
+            elif isinstance(parent, ast.Call) and parent.func is cur and path:
+                method = path.pop()
+                if (
+                    not path
+                    and method == "get"
+                    and parent.args
+                    and isinstance(parent.args[0], ast.Constant)
+                ):
+                    path.append(parent.args[0].value)
+                break
+            else:
+                break
+            cur = parent
+        if not path or path[0] in DICT_METHODS:
+            return None
+        paths.add(tuple(path))
+    return paths
+
+
+def referenced_paths(queries):
+    """
+    Paths of the fields of the input items that the query reads
+
+    Returns None if the items may be needed as a whole, for example when they are updated,
+    passed to functions or output as they are.
+
+    >>> sorted(referenced_paths(parse_query("(.ts > 5), {a: .b.c, d: .d}, {e: .f}")[0]))
+    [('b', 'c'), ('d',), ('ts',)]
+    >>> referenced_paths(parse_query("(.ts > 5), {a: .b, ...}")[0]) is None
+    True
+    """
+    ret = set()
+    for qtype, expr in query_stages(queries):
+        if qtype not in ("map", "filter"):
+            return None
+        paths = field_paths(expr)
+        if paths is None:
+            return None
+        ret.update(paths)
+        if qtype == "map":
+            return ret
+    return None
+
+
+def referenced_fields(queries):
+    """
+    Top level fields of the input items that the query reads
+
+    >>> sorted(referenced_fields(parse_query("(.ts > 5), {a: .b.c, d: .d}, {e: .f}")[0]))
+    ['b', 'd', 'ts']
+    """
+    paths = referenced_paths(queries)
+    return {path[0] for path in paths} if paths is not None else None
+
+
+def field_tree(paths):
+    """
+    Nested dicts of paths, where None stands for the whole value
+
+    >>> field_tree({("a", "b"), ("a", "c"), ("d",), ("d", "e")})
+    {'d': None, 'a': {'b': None, 'c': None}}
+    """
+    tree = {}
+    for path in sorted(paths, key=lambda path: (len(path), path)):
+        node = tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                break
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+def lazy_filters(queries):
+    """
+    Whether the query starts with filters which only read fields of the items
+
+    >>> lazy_filters(parse_query("(.a > 1), (.b.c), {d: .e, ...}")[0])
+    True
+    >>> lazy_filters(parse_query("(len(x) > 1)")[0])
+    False
+    """
+    stages = query_stages(queries)
+    if not stages or stages[0][0] != "filter":
+        return False
+    for qtype, expr in stages:
+        if qtype != "filter":
+            break
+        if field_paths(expr) is None:
+            return False
+    return True
+
+
+COMPARISONS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.In: "in",
+}
+FLIPPED = {
+    "<": ">",
+    "<=": ">=",
+    ">": "<",
+    ">=": "<=",
+    "==": "==",
+    "!=": "!=",
+    "in": "contains",
+}
+
+
+def _literal(node):
+    try:
+        value = ast.literal_eval(node)
+    except Exception:
+        return None, False
+    if isinstance(value, (list, tuple, set)):
+        if all(isinstance(it, (str, int, float, bool)) for it in value):
+            return list(value), True
+        return None, False
+    return value, isinstance(value, (str, int, float, bool))
+
+
+def _field(node):
+    paths = field_paths(node)
+    if (
+        isinstance(node, (ast.Attribute, ast.Subscript))
+        and paths
+        and len(paths) == 1
+        and len(next(iter(paths))) == 1
+    ):
+        return next(iter(paths))[0]
+    return None
+
+
+def _comparison_dnf(node):
+    conjuncts = []
+    left = node.left
+    for op, right in zip(node.ops, node.comparators):
+        op_name = COMPARISONS.get(type(op))
+        field, (value, ok) = _field(left), _literal(right)
+        if field is None:
+            field, (value, ok) = _field(right), _literal(left)
+            op_name = FLIPPED.get(op_name)
+        if field is not None and ok and op_name:
+            if (op_name == "in") == isinstance(value, list):
+                conjuncts.append((field, op_name, value))
+        left = right
+    return [conjuncts] if conjuncts else None
+
+
+def _filter_dnf(node):
+    """Disjunctive normal form of the comparisons implied by a filter expression"""
+    if isinstance(node, ast.Compare):
+        return _comparison_dnf(node)
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        ret = [[]]
+        for part in filter(None, map(_filter_dnf, node.values)):
+            ret = [a + b for a in ret for b in part]
+        return ret if ret != [[]] and len(ret) <= 64 else None
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
+        parts = list(map(_filter_dnf, node.values))
+        if any(part is None for part in parts):
+            return None
+        return [conj for part in parts for conj in part]
+    return None
+
+
+def filter_predicates(queries):
+    """
+    Simple comparisons implied by the filters at the start of the query
+
+    Returns filters in disjunctive normal form, a list of lists of (field, op, value),
+    which every item passing the leading filters satisfies. Returns None if there
+    are no such comparisons. "value in .field" gives the op "contains".
+
+    >>> filter_predicates(parse_query('(.ts > 5 and (.a == "x" or .a in ["y"])), (len(.b) > 1)')[0])
+    [[('ts', '>', 5), ('a', '==', 'x')], [('ts', '>', 5), ('a', 'in', ['y'])]]
+    >>> filter_predicates(parse_query('("err" in .msg)')[0])
+    [[('msg', 'contains', 'err')]]
+    >>> filter_predicates(parse_query('{a: .b}, (.a > 1)')[0]) is None
+    True
+    """
+    ret = [[]]
+    for qtype, expr in query_stages(queries):
+        if qtype != "filter":
+            break
+        dnf = _filter_dnf(expr)
+        if dnf is not None:
+            ret = [a + b for a in ret for b in dnf]
+    return ret if ret != [[]] and len(ret) <= 64 else None
+
+
+def pushdown(queries):
+    """
+    Columns and filters input readers can apply before the query
+
+    columns are the top level fields and paths the tree of fields (see field_tree)
+    read by the query, or None for all. lazy tells that the query starts with filters
+    which only read fields, so that records can be decoded as the filters need them.
+
+    >>> pushdown(parse_query("(.a > 1), {b: .b.c}")[0])
+    {'columns': ['a', 'b'], 'filters': [[('a', '>', 1)]], 'paths': {'a': None, 'b': {'c': None}}, 'lazy': True}
+    """
+    try:
+        paths = referenced_paths(queries)
+    except SyntaxError:
+        # Leave reporting the error to running the query
+        return None
+    return {
+        "columns": sorted({path[0] for path in paths}) if paths is not None else None,
+        "filters": filter_predicates(queries),
+        "paths": field_tree(paths) if paths is not None else None,
+        "lazy": lazy_filters(queries),
+    }
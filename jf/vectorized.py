@@ -0,0 +1,410 @@
+"""
+Columnar execution of the arithmetic and comparison stages of a query
+
+With --vectorize, runs of filter, update and map stages whose expressions only
+use fields, numbers, strings, arithmetic and comparisons are evaluated with
+numpy on columns of a whole batch of items at a time. Other stages run item by
+item as usual. A batch whose values do not fit the columns (missing fields,
+mixed types, division by zero, ...) is run item by item instead, so the results
+are the same either way.
+"""
+import ast
+
+BINOPS = {
+    ast.Add: "add",
+    ast.Sub: "subtract",
+    ast.Mult: "multiply",
+    ast.Div: "true_divide",
+    ast.FloorDiv: "floor_divide",
+    ast.Mod: "remainder",
+}
+CMPOPS = {
+    ast.Eq: "equal",
+    ast.NotEq: "not_equal",
+    ast.Lt: "less",
+    ast.LtE: "less_equal",
+    ast.Gt: "greater",
+    ast.GtE: "greater_equal",
+}
+# Integers are int64 columns. Results which may not fit are run item by item
+INT_BITS = 62
+# Integers above this are not exact as floats
+FLOAT_INT_BITS = 53
+
+
+class Unsupported(Exception):
+    """The values of a batch can not be evaluated as columns"""
+
+
+def field_path(node, arg):
+    """
+    Path of a field reference like x.a.b, or None
+
+    >>> field_path(ast.parse("x.a.b", mode="eval").body, "x")
+    ('a', 'b')
+    >>> field_path(ast.parse("y.a", mode="eval").body, "x")
+    """
+    path = []
+    while isinstance(node, ast.Attribute):
+        path.append(node.attr)
+        node = node.value
+    if path and isinstance(node, ast.Name) and node.id == arg:
+        return tuple(reversed(path))
+    return None
+
+
+def supported(node, arg):
+    """
+    Whether an expression can be evaluated on columns
+
+    >>> supported(ast.parse("(x.a / x.b > 0.9) and not x.c == 'ok'", mode="eval").body, "x")
+    True
+    >>> supported(ast.parse("x.a.lower() == 'ok'", mode="eval").body, "x")
+    False
+    """
+    if field_path(node, arg):
+        return True
+    if isinstance(node, ast.Constant):
+        return type(node.value) in (int, float, str)
+    if isinstance(node, ast.BinOp):
+        return (
+            type(node.op) in BINOPS
+            and supported(node.left, arg)
+            and supported(node.right, arg)
+        )
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)) and supported(
+            node.operand, arg
+        )
+    if isinstance(node, ast.Compare):
+        return all(type(op) in CMPOPS for op in node.ops) and all(
+            supported(it, arg) for it in [node.left] + node.comparators
+        )
+    if isinstance(node, ast.BoolOp):
+        return all(supported(it, arg) for it in node.values)
+    return False
+
+
+def vector_stage(stage):
+    """
+    Columnar version of a ["op", lambda x: ...] stage of a parsed query, or None
+
+    >>> vector_stage(ast.parse('["filter", lambda x: (x.a > 1)]', mode="eval").body)
+    ('filter', 'x', <ast.Compare ...>)
+    >>> vector_stage(ast.parse('["update", lambda x: {"r": x.a / x.b}]', mode="eval").body)
+    ('update', 'x', [('r', <ast.BinOp ...>)])
+    >>> vector_stage(ast.parse('["map", lambda x: x.a]', mode="eval").body)
+    """
+    if not isinstance(stage, ast.List) or len(stage.elts) != 2:
+        return None
+    op, fn = stage.elts
+    if not isinstance(op, ast.Constant) or not isinstance(fn, ast.Lambda):
+        return None
+    if len(fn.args.args) != 1:
+        return None
+    arg = fn.args.args[0].arg
+    body = fn.body
+    if op.value == "filter" and supported(body, arg):
+        return ("filter", arg, body)
+    if op.value in ("update", "map") and isinstance(body, ast.Dict):
+        keys = [k.value if isinstance(k, ast.Constant) else None for k in body.keys]
+        if all(isinstance(k, str) for k in keys) and all(
+            supported(v, arg) for v in body.values
+        ):
+            return (op.value, arg, list(zip(keys, body.values)))
+    return None
+
+
+def vector_stages(queries):
+    """
+    Columnar versions of the stages of a parsed query, None for the others
+
+    >>> [it and it[0] for it in vector_stages('[["filter", lambda x: (x.a > 1)], ["function", lambda x: first(lambda x: 1)]]')]
+    ['filter', None]
+    """
+    try:
+        tree = ast.parse(queries, mode="eval").body
+    except SyntaxError:
+        return None
+    if not isinstance(tree, ast.List):
+        return None
+    return [vector_stage(it) for it in tree.elts]
+
+
+class Columns:
+    """
+    Items of a batch with the columns of their fields
+
+    Updates are kept as columns and only written to copies of the items which are
+    left at the end of the stages.
+
+    >>> c = Columns([{"a": 1, "b": 2}, {"a": 3, "b": 0}])
+    >>> c.run([vector_stage(ast.parse(it, mode="eval").body) for it in [
+    ...     '["update", lambda x: {"c": x.a * 2 + x.b, "d": x.a > 1}]',
+    ...     '["filter", lambda x: x.c > 4]']])
+    [{'a': 3, 'b': 0, 'c': 6, 'd': True}]
+    >>> c = Columns([{"a": 1}, {"a": None}])
+    >>> c.run([vector_stage(ast.parse('["filter", lambda x: x.a > 0]', mode="eval").body)])
+    Traceback (most recent call last):
+    ...
+    jf.vectorized.Unsupported: ('a',)
+    """
+
+    def __init__(self, items):
+        from .process import LazyRecord, materialized
+
+        if LazyRecord in set(map(type, items)):
+            items = list(map(materialized, items))
+        self.items = items
+        # Field: values of the updated fields, as lists or numpy arrays
+        self.updates = {}
+        # Whether a map has replaced the items with the updated fields
+        self.mapped = False
+        self.columns = {}
+
+    def values(self, path):
+        """Values of a field of each item"""
+        from itertools import repeat
+
+        if path[0] in self.updates:
+            ret = self.updates[path[0]]
+            ret = ret.tolist() if hasattr(ret, "tolist") else ret
+        elif self.mapped:
+            ret = [None] * len(self.items)
+        else:
+            ret = list(map(dict.get, self.items, repeat(path[0])))
+        for k in path[1:]:
+            ret = [dict.get(it, k) if isinstance(it, dict) else None for it in ret]
+        return ret
+
+    def column(self, path):
+        """numpy array, kind and bit length of the integers of a field"""
+        import numpy as np
+
+        if path in self.columns:
+            return self.columns[path]
+        values = self.values(path)
+        kinds = set(map(type, values))
+        if kinds == {int}:
+            try:
+                arr = np.array(values, dtype=np.int64)
+            except OverflowError:
+                raise Unsupported(path)
+            bits = max(-int(arr.min()), int(arr.max())).bit_length()
+            col = (arr, "int", bits)
+        elif kinds == {float}:
+            col = (np.array(values, dtype=np.float64), "float", 0)
+        elif kinds == {str}:
+            col = (np.array(values, dtype=object), "str", 0)
+        else:
+            raise Unsupported(path)
+        self.columns[path] = col
+        return col
+
+    def evaluate(self, node, arg):
+        """Value, kind and bit length of the integers of an expression"""
+        import numpy as np
+
+        path = field_path(node, arg)
+        if path:
+            return self.column(path)
+        if isinstance(node, ast.Constant):
+            value = node.value
+            if isinstance(value, int):
+                return value, "int", abs(value).bit_length()
+            return value, "float" if isinstance(value, float) else "str", 0
+        if isinstance(node, ast.BinOp):
+            left, lkind, lbits = self.evaluate(node.left, arg)
+            right, rkind, rbits = self.evaluate(node.right, arg)
+            if not {lkind, rkind} <= {"int", "float"}:
+                raise Unsupported(node)
+            op = type(node.op)
+            if "float" in (lkind, rkind) or op is ast.Div:
+                if max(lbits, rbits) > FLOAT_INT_BITS:
+                    raise Unsupported(node)
+                kind, bits = "float", 0
+            elif op is ast.Mult:
+                kind, bits = "int", lbits + rbits
+            elif op is ast.Mod:
+                kind, bits = "int", rbits
+            else:
+                kind, bits = "int", max(lbits, rbits) + 1
+            if bits > INT_BITS:
+                raise Unsupported(node)
+            return getattr(np, BINOPS[op])(left, right), kind, bits
+        if isinstance(node, ast.UnaryOp):
+            value, kind, bits = self.evaluate(node.operand, arg)
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(self.truth(value, kind)), "bool", 0
+            if kind not in ("int", "float"):
+                raise Unsupported(node)
+            if isinstance(node.op, ast.USub):
+                value = np.negative(value)
+            return value, kind, bits
+        if isinstance(node, ast.Compare):
+            ret = None
+            left = self.evaluate(node.left, arg)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.evaluate(comparator, arg)
+                kinds = {left[1], right[1]}
+                if kinds == {"int", "float"}:
+                    if max(left[2], right[2]) > FLOAT_INT_BITS:
+                        raise Unsupported(node)
+                elif len(kinds) > 1 or kinds == {"bool"}:
+                    raise Unsupported(node)
+                test = getattr(np, CMPOPS[type(op)])(left[0], right[0])
+                ret = test if ret is None else np.logical_and(ret, test)
+                left = right
+            return ret, "bool", 0
+        if isinstance(node, ast.BoolOp):
+            values = [self.evaluate(it, arg) for it in node.values]
+            if any(kind != "bool" for _, kind, _ in values):
+                raise Unsupported(node)
+            fn = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return fn.reduce([value for value, _, _ in values]), "bool", 0
+        raise Unsupported(node)
+
+    def truth(self, value, kind):
+        import numpy as np
+
+        if kind == "bool":
+            return value
+        return np.not_equal(value, "" if kind == "str" else 0)
+
+    def output(self, node, arg):
+        """Values of an expression for each item, and its column if it has one"""
+        import numpy as np
+
+        path = field_path(node, arg)
+        if path:
+            # Copied as they are, whatever their type
+            return self.values(path), None
+        if isinstance(node, ast.Constant):
+            return [node.value] * len(self.items), None
+        value, kind, bits = self.evaluate(node, arg)
+        arr = np.broadcast_to(value, (len(self.items),))
+        return arr, (arr, kind, bits)
+
+    def run(self, stages):
+        """Run the stages on the items. Raises Unsupported if they can not be"""
+        from itertools import compress
+
+        import numpy as np
+
+        for op, arg, body in stages:
+            if not self.items:
+                return []
+            if op == "filter":
+                mask = self.truth(*self.evaluate(body, arg)[:2])
+                mask = np.broadcast_to(mask, (len(self.items),))
+                keep = mask.tolist()
+                self.items = list(compress(self.items, keep))
+                self.updates = {
+                    k: v[mask] if hasattr(v, "shape") else list(compress(v, keep))
+                    for k, v in self.updates.items()
+                }
+                self.columns = {
+                    path: (arr[mask], kind, bits)
+                    for path, (arr, kind, bits) in self.columns.items()
+                }
+                continue
+            outputs = [(k, *self.output(v, arg)) for k, v in body]
+            if op == "map":
+                self.mapped = True
+                self.updates = {}
+                self.columns = {}
+            for k, values, col in outputs:
+                self.updates[k] = values
+                self.columns = {p: c for p, c in self.columns.items() if p[0] != k}
+                if col:
+                    self.columns[(k,)] = col
+        return self.result()
+
+    def result(self):
+        """Copies of the items with the updates written to them"""
+        from .process import DotAccessible
+
+        if not self.updates and not self.mapped:
+            return self.items
+        keys = list(self.updates)
+        values = [
+            v.tolist() if hasattr(v, "tolist") else v for v in self.updates.values()
+        ]
+        if self.mapped:
+            return [DotAccessible(zip(keys, row)) for row in zip(*values)]
+        ret = list(map(DotAccessible, self.items))
+        for it, row in zip(ret, zip(*values)):
+            dict.update(it, zip(keys, row))
+        return ret
+
+
+def vector_batch(stages, fused, items):
+    """
+    Run columnar stages on a batch of items, or fused, their item by item version
+
+    >>> from jf.process import fuse
+    >>> query = '[["update", lambda x: {"c": x.a / x.b}], ["filter", lambda x: (x.c > 1)]]'
+    >>> stages = vector_stages(query)
+    >>> fused = fuse(eval(query))
+    >>> vector_batch(stages, fused, [{"a": 3, "b": 2}, {"a": 1, "b": 2}])
+    [{'a': 3, 'b': 2, 'c': 1.5}]
+    >>> vector_batch(stages, fused, [{"a": 3, "b": 2.0}, {"a": 1, "b": 2}])
+    [{'a': 3, 'b': 2.0, 'c': 1.5}]
+    >>> vector_batch(stages, fused, [{"a": 3, "b": 0}])
+    Traceback (most recent call last):
+    ...
+    ZeroDivisionError: division by zero
+    """
+    import numpy as np
+
+    from .process import fused_batch
+
+    try:
+        with np.errstate(all="raise"):
+            return Columns(items).run(stages)
+    except (Unsupported, FloatingPointError):
+        pass
+    return fused_batch(fused, items)
+
+
+def vector_map(fs, stages, arr, batched=False):
+    """
+    mymap which runs the stages which have a columnar version on batches of items
+
+    stages are the columnar versions of fs, see vector_stages.
+
+    >>> from jf.extra_functions import First as first
+    >>> query = ('[["update", lambda x: {"b": x.a * 2}],'
+    ...          ' ["function", lambda x: first(lambda x: 2)], ["filter", lambda x: x.b > 2]]')
+    >>> list(vector_map(eval(query), vector_stages(query), [{"a": 1}, {"a": 2}, {"a": 3}]))
+    [{'a': 2, 'b': 4}]
+    """
+    from functools import partial
+    from itertools import chain, groupby
+
+    from .jfio import BATCH_SIZE
+    from .process import asdotaccessible, batches, fuse, fused_batch, materialized
+    from .process import track_inputs
+
+    def kind(it):
+        (op, _), stage = it
+        return "function" if op == "function" else "vector" if stage else "item"
+
+    inputs = set()
+    if batched:
+        arr = (list(track_inputs(batch, inputs)) for batch in arr)
+    else:
+        arr = batches(track_inputs(arr, inputs), BATCH_SIZE)
+    for k, group in groupby(zip(fs, stages), kind):
+        group = list(group)
+        if k == "vector":
+            fused = fuse([f for f, _ in group], inputs)
+            arr = map(partial(vector_batch, [s for _, s in group], fused), arr)
+        elif k == "item":
+            arr = map(partial(fused_batch, fuse([f for f, _ in group], inputs)), arr)
+        else:
+            items = chain.from_iterable(arr)
+            for (_, _f), _ in group:
+                items = _f(1)(map(asdotaccessible, map(materialized, items)))
+            arr = batches(items, BATCH_SIZE)
+    yield from chain.from_iterable(arr)
@@ -33,6 +33,7 @@ setup(
         "Topic :: Utilities",
     ],
     packages=["jf"],
+    python_requires=">=3.9",
     setup_requires=["setuptools>=20.2.2"],
     ext_modules=[
         Extension(
@@ -14,3 +14,118 @@ def test_main():
         )
         assert result.exit_code == 0, repr((result.exit_code, result.output))
         assert result.output == '"myvalue"\n', repr(result.output)
+
+
+def test_http_input():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    body = b"".join(b'{"a": %d}\n' % i for i in range(20000))
+    ranges = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            rng = self.headers.get("Range")
+            ranges.append(rng)
+            start = int(rng[len("bytes=") : -1]) if rng else 0
+            self.send_response(206 if rng else 200)
+            self.send_header("Content-Length", str(len(body) - start))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            # break the first response half way through
+            self.wfile.write(body[start:] if rng else body[: len(body) // 2])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        runner = CliRunner()
+        result = runner.invoke(main, ["-c", ".a", f"{url}/1.jsonl", f"{url}/2.jsonl"])
+        assert result.exit_code == 0, repr((result.exit_code, result.output))
+        expected = "".join(f"{i}\n" for i in range(20000))
+        assert result.output == expected * 2
+        # both downloads were resumed from where they broke
+        resumed = [int(rng[len("bytes=") : -1]) for rng in ranges if rng]
+        assert ranges.count(None) == 2 and len(resumed) == 2, ranges
+        assert all(0 < it <= len(body) // 2 for it in resumed), ranges
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_malformed_records(caplog):
+    runner = CliRunner()
+    with tempfile.NamedTemporaryFile(suffix=".jsonl") as tmpfile:
+        tmpfile.write(b'{"a": 1}\n{"a": }\n{"a": 2}\n') and True
+        tmpfile.flush()
+        result = runner.invoke(main, ["-c", ".a", tmpfile.name])
+        assert result.exit_code == 0, repr((result.exit_code, result.output))
+        assert "1\n2\n" in result.output, repr(result.output)
+        assert f"skipped 1 malformed json records in {tmpfile.name}" in caplog.text
+
+
+def test_source_field():
+    runner = CliRunner()
+    with tempfile.NamedTemporaryFile(suffix=".jsonl") as f1, tempfile.NamedTemporaryFile(
+        suffix=".jsonl"
+    ) as f2:
+        f1.write(b'{"i": 1}\n{"i": 2}\n') and True
+        f1.flush()
+        f2.write(b'{"i": 3}\n') and True
+        f2.flush()
+        args = ["-c", "--source_field", "src"]
+        result = runner.invoke(main, args + ["(.i > 1)", f1.name, f2.name])
+        assert result.exit_code == 0, repr((result.exit_code, result.output))
+        assert result.output == (
+            f'{{"i": 2, "src": "{f1.name}"}}\n{{"i": 3, "src": "{f2.name}"}}\n'
+        ), repr(result.output)
+        query = f'(.src == "{f2.name}")'
+        result = runner.invoke(main, args + [query, f1.name, f2.name])
+        assert result.exit_code == 0, repr((result.exit_code, result.output))
+        assert result.output == f'{{"i": 3, "src": "{f2.name}"}}\n', repr(result.output)
+
+
+def test_dict_method_fields():
+    runner = CliRunner()
+    with tempfile.NamedTemporaryFile(suffix=".jsonl") as tmpfile:
+        tmpfile.write(b'{"items": 1, "keys": {"get": 2}, "values": [3]}\n') and True
+        tmpfile.flush()
+        for query, output in [
+            (".", '{"items": 1, "keys": {"get": 2}, "values": [3]}\n'),
+            ("{items: .items, get: .keys.get}", '{"items": 1, "get": 2}\n'),
+        ]:
+            result = runner.invoke(main, ["-c", query, tmpfile.name])
+            assert result.exit_code == 0, repr((result.exit_code, result.output))
+            assert result.output == output, repr(result.output)
+        result = runner.invoke(main, ["--output", "yaml", ".keys", tmpfile.name])
+        assert result.exit_code == 0, repr((result.exit_code, result.output))
+        assert result.output == "get: 2\n\n", repr(result.output)
+
+
+def test_batch_map_processes():
+    runner = CliRunner()
+    data = "".join('{"i": %d}\n' % i for i in range(300))
+    query = "batch_map(lambda v: [len(v)] * len(v), size=64)"
+    result = runner.invoke(main, ["-c", "--processes", "2", query], input=data)
+    assert result.exit_code == 0, repr((result.exit_code, result.output))
+    sizes = list(map(int, result.output.split()))
+    assert sizes == [64] * 256 + [44] * 44, sizes
+
+
+def test_pipeline_pool_early_stop():
+    from jf import process
+
+    data = [{"a": i} for i in range(5000)]
+    additionals = {"JF_init_codes": []}
+    args = dict(processes=2, start_method="spawn")
+    ret = process.run_query("{b: .a}, first(2)", data, additionals, **args)
+    assert list(ret) == [{"b": 0}, {"b": 1}]
+    # The work still in the pool is stopped with the pool
+    assert process._pool is None
+    ret = process.run_query("{b: .a}", data, additionals, **args)
+    assert len(list(ret)) == 5000
+    assert process._pool is not None
+    process.discard_pool(process._pool[1])